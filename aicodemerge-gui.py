@@ -1,154 +1,24 @@
 #!/usr/bin/env python3
 
 import sys
+import concurrent.futures
 import datetime
 import os
+import time
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QFileDialog, QProgressBar, QMessageBox, QLineEdit, QSpinBox, QTextEdit
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSignal, QThread, QTimer
 from PyQt5.QtGui import QDragEnterEvent, QDropEvent
 
-# Import only necessary functions from the original script
-from aicodemerge import parse_gitignore, should_include_file, append_file_content
+from aicodemerge import DEFAULT_EXCLUDE_PATTERNS, ProjectMerge, OutputWriter, project_files
+from aicodemerge import GitignoreMatcher, scan_index, filter_index, count_file_tokens, byte_ratio_counter, find_binary_files
+from aicodemerge import ExcludeMatcher, batch_output_files
 
-DEFAULT_EXCLUDE_PATTERNS = [
-    # Git-related
-    '.git',  # Exclude the entire .git directory
-    '.git/*',  # Exclude all direct children of .git
-    '**/.git',  # Exclude .git directories at any depth
-    '**/.git/**',  # Exclude all contents of any .git directory at any depth
-
-    # Version Control Systems
-    '.svn', '.hg', '.gitignore', '.gitattributes',
-
-    # Dependency Directories
-    'node_modules', 'node_modules/**', 'vendor', 'bower_components', 'jspm_packages',
-
-    # Build Outputs
-    'build', 'dist', 'out', 'target', '.next/**', 'out/**',
-
-    # Compiled Files
-    '*.pyc', '*.pyo', '*.mo', '*.class', '*.dll', '*.exe', '*.o', '*.obj', '*.so',
-    '*.dylib', '*.ncb', '*.sdf', '*.suo', '*.pdb', '*.idb', '.com', '*.exe', '*.o',
-    '*.bundle.js', '*.chunk.js',
-
-    # Logs and Databases
-    '*.log', '*.sql', '*.sqlite', '*.sqlite3', '*.sqlite3-journal',
-
-    # OS Generated Files
-    '.DS_Store', 'Thumbs.db', 'desktop.ini', '._*', '.Spotlight-V100', '.Trashes',
-    'ehthumbs.db', 'ehthumbs_vista.db',
-
-    # Package Manager Files
-    'package-lock.json', 'yarn.lock', 'composer.lock', 'Gemfile.lock',
-
-    # Cache and Temporary Files
-    '.cache', '.tmp', '.temp', '.sass-cache', '__pycache__', '*.py[cod]',
-    '.eslintcache', '.stylelintcache', '.phpunit.result.cache',
-
-    # IDE and Editor Files
-    '.vscode', '.idea', '*.swp', '*.swo', '*.sublime-*', '*.code-workspace',
-    '.project', '.classpath', '.settings/', '*.launch', '.history/',
-
-    # Test and Coverage
-    'coverage', '.nyc_output', '.pytest_cache', '.tox', '.nox',
-    'nosetests.xml', 'coverage.xml',
-
-    # Documentation
-    'docs', '*.md', '*.rst', '*.txt',
-
-    # Media and Archives
-    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.ico', '*.mov', '*.mp4', '*.mp3',
-    '*.flv', '*.fla', '*.zip', '*.tar.gz', '*.rar',
-
-    # Configuration and Environment Files
-    '.env', '.env.*', 'config.json', 'settings.json',
-
-    # Next.js and React
-    '.vercel', 'next-env.d.ts', '.eslintrc*', 'next.config.js', 'next-sitemap.config.js',
-    'public/**', '.pnp.*', '*.pnp.js',
-
-    # iOS and macOS Development
-    '*.xcodeproj', '*.xcworkspace', '*.pbxproj', '*.mode1v3', '*.mode2v3', '*.perspectivev3',
-    '*.xcuserstate', '*.xccheckout', '*.moved-aside', '*.hmap', '*.ipa', '*.dSYM.zip', '*.dSYM',
-    'timeline.xctimeline', 'playground.xcworkspace', '.build/', 'DerivedData/', '*.playgroundbook',
-    'Pods/', 'Carthage/Build',
-
-    # Android Development
-    '*.iml', '.gradle', 'local.properties', '.idea/caches', '.idea/libraries', '.idea/modules.xml',
-    '.idea/workspace.xml', '.idea/navEditor.xml', '.idea/assetWizardSettings.xml', '.externalNativeBuild',
-    '.cxx', '*.apk', '*.aab', '*.ap_', '*.dex',
-
-    # Ruby on Rails
-    '*.rbc', 'capybara-*.html', '.rspec', 'public/system', 'spec/tmp', '**.orig',
-    'rerun.txt', 'pickle-email-*.html', '.bundle', 'vendor/bundle', 'log/*', 'tmp/*',
-    'storage/*', '.byebug_history', 'config/master.key', 'config/credentials.yml.enc',
-
-    # Java
-    '*.class', '*.war', '*.ear', '*.jar', 'hs_err_pid*', '.mtj.tmp/',
-
-    # Python
-    '*.egg-info/', 'pip-log.txt', 'pip-delete-this-directory.txt', '.tox/',
-    '.coverage', '.coverage.*', '.cache', '*.cover', '*.py,cover', '.hypothesis/',
-    'pytestdebug.log', '.python-version', '.mypy_cache', '.dmypy.json', '.pyre/',
-
-    # Go
-    '*.exe', '*.test', '*.prof', '*.out',
-
-    # Rust
-    'target/', 'Cargo.lock', '**/*.rs.bk',
-
-    # .NET
-    '[Bb]in/', '[Oo]bj/', '[Ll]og/', '[Ll]ogs/', '.vs/', '*_i.c', '*_p.c', '*_h.h', '*.ilk',
-    '*.meta', '*.obj', '*.iobj', '*.pch', '*.pdb', '*.ipdb', '*.pgc', '*.pgd', '*.rsp', '*.sbr',
-    '*.tlb', '*.tli', '*.tlh', '*.tmp', '*.tmp_proj', '*_wpftmp.csproj', '*.vspscc', '*.vssscc',
-
-    # Unity
-    '[Ll]ibrary/', '[Tt]emp/', '[Oo]bj/', '[Bb]uild/', '[Bb]uilds/', '[Ll]ogs/', '[Uu]ser[Ss]ettings/',
-    '*.pidb.meta', '*.pdb.meta', '*.mdb.meta', '*.apk', '*.unitypackage', 'crashlytics-build.properties',
-
-    # Jupyter Notebooks
-    '.ipynb_checkpoints', '*/.ipynb_checkpoints/*', '*.ipynb',
-
-    # R
-    '.Rhistory', '.Rapp.history', '.RData', '.Ruserdata', '*-Ex.R', '/*.tar.gz', '/*.Rcheck/',
-    '.Rproj.user/', '*.Rproj',
-
-    # Elm
-    'elm-stuff/', '*.elmo', '*.elmi',
-
-    # Additional Patterns
-    '.ropeproject', '.spyderproject', '.spyproject', '.webassets-cache', '.scrapy',
-    'celerybeat-schedule', 'celerybeat.pid', '*.sage.py', '.venv', 'env/', 'venv/', 'ENV/',
-    '.tern-port', '.vscode-test', '.yarn-integrity', '.expo/', '.expo-shared/',
-    '*.jks', '*.keystore', '*.mobileprovision', '*.provisionprofile',
-    '.sonar', '.scannerwork', '.terraform', '*.tfstate', '*.tfstate.*', '.vagrant',
-    '*.bak', '*.gho', '*.ori', '*.orig', '.Trash-*', '$RECYCLE.BIN/', 'System Volume Information',
-    '*.lnk', '.fseventsd', '.apdisk', '*.patch', '*.diff', '*.kicad_pcb-bak', '*.sch-bak',
-    '~$*.doc*', '~$*.xls*', '~$*.ppt*', '*.~vsd*', '.~lock.*#', 'Thumbs.db:encryptable',
-    '*.stackdump', '[Dd]esktop.ini', '*.code-snippets', '.atom/', '.tags', '.tags_sorted_by_file',
-    '.gemtags', 'tags', 'TAGS', 'cscope.*', '*.rsuser', '*.pid', '*.seed', '*.pid.lock',
-]
-def list_directory(dir_path, gitignore_matcher, patterns, prefix="", current_depth=0, max_depth=4):
-    if current_depth > max_depth:
-        return []
-
-    try:
-        items = os.listdir(dir_path)
-    except PermissionError:
-        return [f"{prefix}[Permission Denied]"]
-
-    structure = []
-    for item in sorted(items):
-        item_path = os.path.join(dir_path, item)
-        if should_include_file(item_path, gitignore_matcher, patterns):
-            structure.append(f"{prefix}{item}")
-            if os.path.isdir(item_path):
-                structure.extend(list_directory(item_path, gitignore_matcher, patterns,
-                                                prefix + "│   ", current_depth + 1, max_depth))
-    return structure
+READ_JOBS = 4
+PROGRESS_INTERVAL = 0.1  # Seconds between progress signals from the merge thread
+PREVIEW_DELAY_MS = 250  # Quiet time after the last filter edit before the preview is refreshed
 
 class DropZone(QLabel):
-    folder_dropped = pyqtSignal(str)
+    folders_dropped = pyqtSignal(list)
 
     def __init__(self):
         super().__init__()
@@ -171,27 +41,158 @@ class DropZone(QLabel):
 
     def dropEvent(self, event: QDropEvent):
         files = [u.toLocalFile() for u in event.mimeData().urls()]
-        if files and os.path.isdir(files[0]):
-            self.folder_dropped.emit(files[0])
+        folders = [f for f in files if os.path.isdir(f)]
+        if folders:
+            self.folders_dropped.emit(folders)
 
-    def set_folder(self, folder):
-        self.setText(f"Selected Folder:\n{folder}")
+    def set_folders(self, folders):
+        if len(folders) == 1:
+            self.setText(f"Selected Folder:\n{folders[0]}")
+        else:
+            self.setText(f"Selected {len(folders)} Folders:\n" + "\n".join(folders))
 
     def clear_folder(self):
         self.setText('\n\n Drop Project Folder Here \n\n')
 
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+class PreScanThread(QThread):
+    # Builds the in-memory index of each folder (every entry plus every
+    # .gitignore, and which files are binary) once, so the preview can
+    # re-filter it without disk access.
+    scanned = pyqtSignal(object, object)  # folders, {folder: (scan_index entries, gitignore cache, binary paths)}
+
+    def __init__(self, folders):
+        super().__init__()
+        self.folders = folders
+
+    def run(self):
+        indexes = {}
+        for folder in self.folders:
+            gitignore_cache = {}
+            index = scan_index(folder, gitignore_cache)
+            indexes[folder] = (index, gitignore_cache, find_binary_files(index))
+        self.scanned.emit(self.folders, indexes)
+
+class MergeThread(QThread):
+    # Runs the merges off the GUI thread, one output file per (project path,
+    # output file) target. All targets share one reader pool and one compiled
+    # exclude matcher. Progress is reported at most every PROGRESS_INTERVAL
+    # seconds so signal traffic stays negligible next to the merge itself.
+    # Cancelling stops after the current file (or directory entry, while
+    # scanning) and deletes the partial output. Bytes written go out as qint64
+    # since outputs can pass 2 GiB.
+    progress = pyqtSignal(int, int, str, 'qint64', float)  # files done, total files, current file, bytes written, ETA seconds (-1 if unknown)
+    completed = pyqtSignal(list)  # output files
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, targets, max_depth, max_size, patterns, exclude_patterns):
+        super().__init__()
+        self.targets = targets
+        self.output_file = None  # The output being written
+        self.max_depth = max_depth
+        self.max_size = max_size
+        self.patterns = patterns
+        self.exclude_patterns = exclude_patterns
+
+    def run(self):
+        try:
+            finished = self.run_aicodemerge()
+        except Exception as e:
+            self.remove_output()
+            self.failed.emit(str(e))
+            return
+        if finished:
+            self.completed.emit([output_file for _, output_file in self.targets])
+        else:
+            self.remove_output()
+            self.cancelled.emit()
+
+    def remove_output(self):
+        if self.output_file is None:
+            return
+        try:
+            os.remove(self.output_file)
+        except OSError:
+            pass
+
+    def run_aicodemerge(self):
+        # Returns False when cancelled before the merges finished
+        with concurrent.futures.ThreadPoolExecutor(max_workers=READ_JOBS) as executor:
+            exclude_matcher = ExcludeMatcher(self.exclude_patterns)
+            merges = []
+            for project_path, output_file in self.targets:
+                merge = ProjectMerge(project_path, self.max_depth, self.max_size, self.patterns, exclude_matcher,
+                                     jobs=READ_JOBS, contents_heading="## File Contents", executor=executor)
+                for _ in merge.iter_entries():
+                    if self.isInterruptionRequested():
+                        return False
+                merges.append((merge, project_files(merge.entries), output_file))
+
+            # Progress and ETA cover all targets together
+            total_files = sum(len(files) for _, files, _ in merges)
+            total_bytes = sum(entry.stat.st_size for _, files, _ in merges for entry in files)
+            done_files = done_bytes = written_bytes = 0
+            start = time.monotonic()
+            last_emit = 0.0
+
+            for merge, _, output_file in merges:
+                self.output_file = output_file
+                with OutputWriter(output_file) as out:
+                    blocks = merge.blocks()
+                    try:
+                        for block in blocks:
+                            if self.isInterruptionRequested():
+                                return False
+                            result = block.result
+                            if block.data is not None:
+                                out.write_block(block.name, block.data)
+                            if result is None:
+                                continue
+                            file_path = result.entry.path
+                            if isinstance(result.error, PermissionError):
+                                print(f"Permission denied: Unable to read {file_path}")
+                            elif result.error is not None:
+                                print(f"Error processing {file_path}: {str(result.error)}")
+                            elif result.skip_reason is not None:
+                                print(f"Skipped {file_path}: {result.skip_reason}")
+
+                            done_files += 1
+                            done_bytes += result.entry.stat.st_size
+                            now = time.monotonic()
+                            if now - last_emit >= PROGRESS_INTERVAL or done_files == total_files:
+                                last_emit = now
+                                elapsed = now - start
+                                eta = elapsed * (total_bytes - done_bytes) / done_bytes if done_bytes else -1.0
+                                self.progress.emit(done_files, total_files, file_path, written_bytes + out.bytes_written, eta)
+                    finally:
+                        blocks.close()  # Cancels reads still queued on the shared pool
+                written_bytes += out.bytes_written
+
+                print(f"Markdown file created: {output_file}")
+                print(f"Location: {os.path.abspath(output_file)}")
+        return True
+
 class AICodeMergeGUI(QWidget):
     def __init__(self):
         super().__init__()
         self.custom_output_file = None
-        self.selected_folder = None
+        self.selected_folders = []
+        self.merge_thread = None
+        self.prescan_threads = []
+        self.indexes = None  # {folder: (scan_index entries, gitignore cache, binary paths)}
         self.initUI()
 
     def initUI(self):
         layout = QVBoxLayout()
 
         self.dropzone = DropZone()
-        self.dropzone.folder_dropped.connect(self.set_folder)
+        self.dropzone.folders_dropped.connect(self.set_folders)
         layout.addWidget(self.dropzone)
 
         folder_buttons_layout = QHBoxLayout()
@@ -258,29 +259,102 @@ class AICodeMergeGUI(QWidget):
 
         layout.addLayout(form_layout)
 
+        process_buttons_layout = QHBoxLayout()
         self.start_button = QPushButton('Start Process')
         self.start_button.clicked.connect(self.start_process)
-        layout.addWidget(self.start_button)
+        process_buttons_layout.addWidget(self.start_button)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_process)
+        self.cancel_button.setEnabled(False)
+        process_buttons_layout.addWidget(self.cancel_button)
+        layout.addLayout(process_buttons_layout)
 
         self.progress_bar = QProgressBar()
         layout.addWidget(self.progress_bar)
 
+        self.status_label = QLabel('')
+        self.status_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        layout.addWidget(self.status_label)
+
+        # Live preview of what the current filters include
+        self.preview_label = QLabel('')
+        layout.addWidget(self.preview_label)
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self.preview_timer.timeout.connect(self.update_preview)
+        self.max_size_input.valueChanged.connect(self.schedule_preview)
+        self.patterns_input.textChanged.connect(self.schedule_preview)
+        self.exclude_input.textChanged.connect(self.schedule_preview)
+
         self.setLayout(layout)
         self.setWindowTitle('AICodeMerge')
         self.setGeometry(300, 300, 600, 500)  # Increased height to accommodate new elements
 
-    def set_folder(self, folder):
-        self.selected_folder = folder
-        self.dropzone.set_folder(folder)
+    def set_folders(self, folders):
+        self.selected_folders = folders
+        self.dropzone.set_folders(folders)
+        self.start_prescan(folders)
 
     def select_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Project Folder")
         if folder:
-            self.set_folder(folder)
+            self.set_folders([folder])
 
     def remove_folder(self):
-        self.selected_folder = None
+        self.selected_folders = []
         self.dropzone.clear_folder()
+        self.indexes = None
+        self.preview_timer.stop()
+        self.preview_label.setText('')
+
+    def start_prescan(self, folders):
+        self.indexes = None
+        self.preview_timer.stop()
+        self.preview_label.setText('Scanning folders for preview...' if len(folders) > 1 else 'Scanning folder for preview...')
+        # A scan still running for a previous selection is left to finish;
+        # its result is dropped in prescan_finished
+        thread = PreScanThread(folders)
+        thread.scanned.connect(self.prescan_finished)
+        thread.finished.connect(lambda: self.prescan_threads.remove(thread))
+        self.prescan_threads.append(thread)
+        thread.start()
+
+    def prescan_finished(self, folders, indexes):
+        if folders is not self.selected_folders:
+            return
+        self.indexes = indexes
+        self.update_preview()
+
+    def schedule_preview(self):
+        if self.indexes is not None:
+            self.preview_timer.start()  # Restarting the timer debounces bursts of edits
+
+    def update_preview(self):
+        if self.indexes is None:
+            return
+        start = time.perf_counter()
+        max_size = self.max_size_input.value()
+        patterns, exclude_patterns = self.filter_inputs()
+        exclude_matcher = ExcludeMatcher(exclude_patterns)
+        files = []
+        binary_files = set()
+        for folder, (index, gitignore_cache, binary) in self.indexes.items():
+            matcher = GitignoreMatcher(folder, exclude_matcher, gitignore_cache)
+            files.extend(project_files(filter_index(index, matcher, patterns)))
+            binary_files |= binary
+        total_bytes = sum(entry.stat.st_size for entry in files)
+        tokens = count_file_tokens(files, max_size, byte_ratio_counter(), binary_files=binary_files)
+        total_tokens = sum(count for count in tokens.values() if count is not None)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.preview_label.setText(f"Preview: {len(files)} files, {format_bytes(total_bytes)}, "
+                                   f"~{total_tokens:,} tokens (filtered in {elapsed_ms:.0f} ms)")
+
+    def filter_inputs(self):
+        patterns = [p.strip() for p in self.patterns_input.text().split(',')]
+        exclude_patterns = [p.strip() for p in self.exclude_input.toPlainText().split('\n') if p.strip()]
+        return patterns, exclude_patterns
 
     def reset_exclude_patterns(self):
         self.exclude_input.setPlainText('\n'.join(DEFAULT_EXCLUDE_PATTERNS))
@@ -292,85 +366,84 @@ class AICodeMergeGUI(QWidget):
             self.output_file_input.setText(file_name)
 
     def start_process(self):
-        if not self.selected_folder:
+        if not self.selected_folders:
             QMessageBox.warning(self, "No Folder Selected", "Please select a project folder before starting the process.")
             return
 
-        self.process_folder(self.selected_folder)
+        self.process_folders(self.selected_folders)
 
-    def process_folder(self, folder_path):
-        if not os.access(folder_path, os.R_OK):
-            QMessageBox.critical(self, "Permission Denied", f"Cannot access the folder: {folder_path}\nPlease check your permissions and try again.")
-            return
+    def process_folders(self, folders):
+        for folder_path in folders:
+            if not os.access(folder_path, os.R_OK):
+                QMessageBox.critical(self, "Permission Denied", f"Cannot access the folder: {folder_path}\nPlease check your permissions and try again.")
+                return
 
         # Get values from input fields
         max_depth = self.max_depth_input.value()
         max_size = self.max_size_input.value()
-        patterns = [p.strip() for p in self.patterns_input.text().split(',')]
-        exclude_patterns = [p.strip() for p in self.exclude_input.toPlainText().split('\n') if p.strip()]
+        patterns, exclude_patterns = self.filter_inputs()
 
-        # Determine output file
-        if self.custom_output_file:
-            output_file = self.custom_output_file
+        # Determine output files. With several folders each one gets
+        # ProjectName_Timestamp.md, next to the custom output file if one is set.
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        if self.custom_output_file and len(folders) == 1:
+            output_files = [self.custom_output_file]
         else:
-            project_name = os.path.basename(os.path.abspath(folder_path))
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_file = f"{project_name}_{timestamp}.md"
+            output_dir = os.path.dirname(self.custom_output_file) if self.custom_output_file else ""
+            output_files = batch_output_files(folders, output_dir, timestamp, ".md")
 
         self.progress_bar.setValue(0)
+        self.status_label.setText('Scanning project...')
+        self.start_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+
+        self.merge_thread = MergeThread(list(zip(folders, output_files)), max_depth, max_size, patterns, exclude_patterns)
+        self.merge_thread.progress.connect(self.update_progress)
+        self.merge_thread.completed.connect(self.merge_completed)
+        self.merge_thread.cancelled.connect(self.merge_cancelled)
+        self.merge_thread.failed.connect(self.merge_failed)
+        self.merge_thread.finished.connect(self.merge_thread_finished)
+        self.merge_thread.start()
+
+    def cancel_process(self):
+        if self.merge_thread is not None and self.merge_thread.isRunning():
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText('Cancelling...')
+            self.merge_thread.requestInterruption()
+
+    def update_progress(self, done, total, file_path, bytes_written, eta):
+        self.progress_bar.setValue(int((done / total) * 100) if total else 100)
+        eta_text = f", about {eta:.0f}s left" if eta >= 0 else ""
+        self.status_label.setText(f"{done}/{total} files, {format_bytes(bytes_written)} written{eta_text}\n{file_path}")
+
+    def merge_completed(self, output_files):
+        self.progress_bar.setValue(100)
+        self.status_label.setText('')
+        if len(output_files) == 1:
+            QMessageBox.information(self, "Process Complete", f"AICodeMerge has finished processing the folder.\nOutput file: {output_files[0]}")
+        else:
+            QMessageBox.information(self, "Process Complete", f"AICodeMerge has finished processing {len(output_files)} folders.\n"
+                                    "Output files:\n" + "\n".join(output_files))
 
-        try:
-            self.run_aicodemerge(folder_path, output_file, max_depth, max_size, patterns, exclude_patterns)
-            self.progress_bar.setValue(100)
-            QMessageBox.information(self, "Process Complete", f"AICodeMerge has finished processing the folder.\nOutput file: {output_file}")
-        except Exception as e:
-            QMessageBox.critical(self, "Processing Error", f"An error occurred while processing: {str(e)}")
-
-    def run_aicodemerge(self, project_path, output_file, max_depth, max_size, patterns, exclude_patterns):
-        gitignore_matcher = parse_gitignore(os.path.join(project_path, '.gitignore'), exclude_patterns)
-        
-        with open(output_file, "w", encoding="utf-8") as out:
-            out.write("# Project Knowledge for AI Analysis\n\n")
-            out.write("This markdown file contains the structure and contents of a project. ")
-            out.write("It is organized as follows:\n\n")
-            out.write("1. Project folder structure\n")
-            out.write("2. Contents of relevant files\n\n")
-            out.write("---\n\n")
-            out.write("## Project Configuration\n\n")
-            out.write(f"- Max directory depth: {max_depth}\n")
-            out.write(f"- Max file size: {max_size}KB\n")
-            out.write(f"- File patterns included: {', '.join(patterns)}\n\n")
-            out.write("---\n\n")
-            out.write("## Project Folder Structure\n\n")
-            
-            # Generate and write the folder structure
-            structure = list_directory(project_path, gitignore_matcher, patterns, max_depth=max_depth)
-            out.write("\n".join(structure))
-            
-            out.write("\n\n## File Contents\n")
-
-        files_to_process = []
-        for root, _, files in os.walk(project_path):
-            if any(exclude in root.split(os.path.sep) for exclude in exclude_patterns):
-                continue
-            for file in files:
-                file_path = os.path.join(root, file)
-                if should_include_file(file_path, gitignore_matcher, patterns):
-                    files_to_process.append(file_path)
-
-        total_files = len(files_to_process)
-        for i, file_path in enumerate(files_to_process, 1):
-            try:
-                append_file_content(file_path, output_file, max_size)
-            except PermissionError:
-                print(f"Permission denied: Unable to read {file_path}")
-            except Exception as e:
-                print(f"Error processing {file_path}: {str(e)}")
-            self.progress_bar.setValue(int((i / total_files) * 100))
-
-        print(f"Markdown file created: {output_file}")
-        print(f"Location: {os.path.abspath(output_file)}")
-        return output_file
+    def merge_cancelled(self):
+        self.progress_bar.setValue(0)
+        self.status_label.setText('Cancelled. Partial output removed.')
+
+    def merge_failed(self, message):
+        self.status_label.setText('')
+        QMessageBox.critical(self, "Processing Error", f"An error occurred while processing: {message}")
+
+    def merge_thread_finished(self):
+        self.start_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
+    def closeEvent(self, event):
+        if self.merge_thread is not None and self.merge_thread.isRunning():
+            self.merge_thread.requestInterruption()
+            self.merge_thread.wait()
+        for thread in self.prescan_threads:
+            thread.wait()
+        super().closeEvent(event)
 
 def main():
     app = QApplication(sys.argv)
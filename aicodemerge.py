@@ -5,6 +5,44 @@ import argparse
 import fnmatch
 import datetime
 import re
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import ctypes
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import mmap
+import pstats
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import queue
+import select
+import threading
+import time
+import tokenize
+import zlib
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 DEFAULT_EXCLUDE_PATTERNS = [
     # Git-related 
@@ -127,12 +165,37 @@ DEFAULT_EXCLUDE_PATTERNS = [
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Generate a Markdown file containing the structure and contents of a project.")
-    parser.add_argument("project_path", help="Path to the project directory")
+    parser.add_argument("project_paths", nargs="*", metavar="project_path", help="Path to the project directory; several paths run a batch")
+    parser.add_argument("--batch", metavar="FILE", help="Batch mode: merge every project listed in FILE (one path per line) into its own output")
     parser.add_argument("-d", "--max-depth", type=int, default=4, help="Maximum depth for directory traversal (default: 4)")
     parser.add_argument("-s", "--max-size", type=int, default=100, help="Maximum file size in KB to include (default: 100)")
     parser.add_argument("-p", "--patterns", default="*", help="File patterns to include, comma-separated (default: *)")
-    parser.add_argument("-o", "--output", help="Specify the output file name (default: PROJECT_NAME_TIMESTAMP.md)")
+    parser.add_argument("-o", "--output", help="Specify the output file name, or - to stream to stdout (default: PROJECT_NAME_TIMESTAMP.md)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="markdown", help="Output format: markdown document, one JSON record per file, or a packed container with an offset index (default: markdown)")
+    parser.add_argument("--tree-last", action="store_true", help="Write the file contents first and the folder structure at the end, so output starts before the scan finishes")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of threads used to read files (default: 1)")
+    parser.add_argument("--git", action="store_true", help="List files from the git index instead of walking the directory tree")
+    parser.add_argument("--dedup", action="store_true", help="Write identical files once; later copies become a reference to the first")
+    parser.add_argument("--token-budget", type=int, help="Maximum estimated tokens in the output; lower-priority files are omitted")
+    parser.add_argument("--tokenizer", default="bytes", help="Token counter: bytes (~4 bytes per token) or tiktoken[:ENCODING] (default: bytes)")
+    parser.add_argument("--priority", choices=sorted(PRIORITIES), default="depth", help="Which files fill the token budget first: shallowest, most recently modified or smallest (default: depth)")
+    parser.add_argument("--split-size", type=parse_size, help="Split the output into numbered parts of at most this many bytes (e.g. 500K, 10M)")
+    parser.add_argument("--split-tokens", type=int, help="Split the output into numbered parts of at most this many estimated tokens")
+    parser.add_argument("--cache", action="store_true", help="Reuse rendered sections of unchanged files from an on-disk cache")
+    parser.add_argument("--cache-dir", help="Directory for cache files (default: ~/.cache/aicodemerge; implies --cache)")
+    parser.add_argument("--incremental", action="store_true", help="Patch an existing output file in place instead of rewriting it (implies --cache)")
+    parser.add_argument("--watch", action="store_true", help="After the merge, keep watching the project and update the output whenever files change (implies --cache)")
+    parser.add_argument("--compress", metavar="CODEC[:LEVEL]", help=f"Compress the output while writing it: {', '.join(sorted(COMPRESSORS))} (zstd needs the zstandard package)")
+    parser.add_argument("--compress-thread", action="store_true", help="Run the compressor on its own thread so reading and rendering never wait for it")
+    parser.add_argument("--truncate", action="store_true", help="Keep the head and tail of files over --max-size instead of leaving them out")
+    parser.add_argument("--truncate-window", type=parse_size, help="Bytes kept from each end of a truncated file (e.g. 16K; default: half of --max-size)")
+    parser.add_argument("--skeleton", action="store_true", help="With --truncate, also list the def/class signatures and docstrings of the elided part of Python files")
+    parser.add_argument("--compact", action="store_true", help="Shrink file contents: strip trailing whitespace, collapse blank lines and write each license header once")
+    parser.add_argument("--strip-comments", action="store_true", help="Also drop comments in Python and C-like languages (implies --compact)")
+    parser.add_argument("--license-pattern", default=DEFAULT_LICENSE_PATTERN, help=f"Regex (case-insensitive) that marks a file's leading comment as a license header; empty to keep them all (default: {DEFAULT_LICENSE_PATTERN})")
+    parser.add_argument("--stats", nargs="?", const="", metavar="FILE", help="Report per-stage timings and scan/read counters; with FILE, write them there as JSON")
+    parser.add_argument("--profile", nargs="?", const="aicodemerge.prof", metavar="FILE", help="Run under cProfile, print the top functions and save the profile to FILE (default: aicodemerge.prof)")
     parser.add_argument("-c", "--custom", action="store_true", help="Use custom configuration mode")
     return parser.parse_args()
 
@@ -166,128 +229,2751 @@ def log_verbose(message, verbose):
     if verbose:
         print(message)
 
-def parse_gitignore(gitignore_path, custom_exclude_patterns):
-    patterns = custom_exclude_patterns.copy()
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r') as f:
-            patterns.extend([line.strip() for line in f if line.strip() and not line.startswith('#')])
+GLOB_CHARS = re.compile(r'[*?[]')
+
+class ExcludeMatcher:
+    # Compiled form of a list of fnmatch-style exclusion patterns. A path is
+    # excluded when any pattern matches either its normalized full path or its
+    # basename, exactly like calling fnmatch.fnmatch on both for every pattern,
+    # but patterns are bucketed so most lookups are a hash probe:
+    #   - literal names ('node_modules')      -> dict keyed by basename
+    #   - literal paths ('config/master.key') -> dict keyed by full path
+    #   - extension globs ('*.pyc')           -> dict keyed by basename suffix
+    #   - everything else                     -> one combined regex
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.basenames = {}
+        self.paths = {}
+        self.extensions = {}
+        self.globs = []
+        for pattern in self.patterns:
+            normalized = os.path.normcase(pattern)
+            if not GLOB_CHARS.search(normalized):
+                if '/' in normalized or os.sep in normalized:
+                    self.paths.setdefault(normalized, pattern)
+                else:
+                    self.basenames.setdefault(normalized, pattern)
+            elif (normalized.startswith('*.') and not GLOB_CHARS.search(normalized[1:])
+                  and '/' not in normalized and os.sep not in normalized):
+                self.extensions.setdefault(normalized[1:], pattern)
+            else:
+                self.globs.append((re.compile(fnmatch.translate(normalized)).match, pattern))
+        if self.globs:
+            self.glob_regex = re.compile('|'.join(fnmatch.translate(os.path.normcase(p)) for _, p in self.globs)).match
+        else:
+            self.glob_regex = None
+
+    def match(self, path, is_dir=None):
+        # Returns the first pattern that excludes `path`, or None. `is_dir` is
+        # accepted for interface compatibility with GitignoreMatcher.
+        path = os.path.normcase(os.path.normpath(path))
+        name = os.path.basename(path)
+        pattern = self.basenames.get(name) or self.paths.get(path)
+        if pattern is not None:
+            return pattern
+        if self.extensions:
+            dot = name.find('.')
+            while dot != -1:
+                pattern = self.extensions.get(name[dot:])
+                if pattern is not None:
+                    return pattern
+                dot = name.find('.', dot + 1)
+        if self.glob_regex and (self.glob_regex(path) or self.glob_regex(name)):
+            for glob_match, pattern in self.globs:
+                if glob_match(path) or glob_match(name):
+                    return pattern
+        return None
+
+    def __call__(self, path, is_dir=None):
+        return self.match(path, is_dir) is not None
+
+def translate_gitignore_glob(pattern):
+    # Regex for one gitignore glob: '*', '?' and '[...]' never cross '/',
+    # '**/' matches any number of leading directories, '/**' everything inside
+    # and '/**/' zero or more directories. A backslash escapes the next char.
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+                if i + 2 == n:
+                    parts.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    parts.append('(?:.*/)?')
+                    i += 3
+                    continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            parts.append('[^/]*')
+            continue
+        if c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                parts.append('\\[')
+            else:
+                chars = pattern[i + 1:j].replace('\\', '\\\\')
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                parts.append(f'(?!/)[{chars}]')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+def parse_gitignore_line(line):
+    # Returns (match, negate, dir_only) for one .gitignore line, or None for
+    # blank lines and comments. `match` takes a '/'-separated path relative to
+    # the directory holding the .gitignore.
+    line = line.rstrip('\r\n')
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '  # An escaped trailing space is kept
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    # A slash anywhere but at the end anchors the pattern to the .gitignore's
+    # directory; otherwise it matches a name at any depth below it
+    if '/' in line:
+        regex = translate_gitignore_glob(line[1:] if line.startswith('/') else line)
+    else:
+        regex = '(?:.*/)?' + translate_gitignore_glob(line)
+    return re.compile(f'(?s:{regex})\\Z').match, negate, dir_only
+
+def read_gitignore_lines(gitignore_path):
+    try:
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.readlines()
+    except OSError:
+        return []
+
+def compile_gitignore(lines, label):
+    rules = []
+    for line in lines:
+        rule = parse_gitignore_line(line)
+        if rule is not None:
+            rules.append(rule + (f"{label}: {line.strip()}",))
+    return rules
+
+class GitignoreRules:
+    # The compiled rules of one .gitignore file, chained to the closest
+    # enclosing directory that has rules of its own. Deeper files take
+    # precedence over shallower ones and later lines over earlier ones.
+    def __init__(self, parent, base, rules):
+        self.parent = parent
+        self.prefix = base + '/' if base else ''
+        self.rules = rules[::-1]
+
+    def match(self, rel_path, path, is_dir):
+        # Returns ("gitignore", rule) for the rule that excludes `rel_path`, or
+        # None when it is not excluded or re-included by a '!' rule
+        node = self
+        while node is not None:
+            local = rel_path[len(node.prefix):]
+            for regex, negate, dir_only, text in node.rules:
+                if not regex(local):
+                    continue
+                if dir_only:
+                    if is_dir is None:
+                        is_dir = os.path.isdir(path)
+                    if not is_dir:
+                        continue
+                return None if negate else ("gitignore", text)
+            node = node.parent
+        return None
+
+class GitignoreMatcher:
+    # Exclusion check for paths inside one project: the default/custom patterns
+    # (fnmatch semantics, see ExcludeMatcher) plus gitignore semantics for
+    # .git/info/exclude and every .gitignore from the project root down to the
+    # path's directory. Each directory's .gitignore is read and compiled the
+    # first time something inside it is checked. `exclude_patterns` may also be
+    # an already compiled ExcludeMatcher, to share one between projects.
+    # `gitignore_cache` maps
+    # .gitignore paths to their lines; pass the same dict to later matchers
+    # (see scan_index) so they don't read the files again.
+    def __init__(self, project_path, exclude_patterns, gitignore_cache=None):
+        self.root = os.path.normpath(project_path)
+        self.prefix = '' if self.root == '.' else os.path.join(self.root, '')
+        if isinstance(exclude_patterns, ExcludeMatcher):
+            self.exclude_matcher = exclude_patterns
+        else:
+            self.exclude_matcher = ExcludeMatcher(exclude_patterns)
+        self.gitignore_cache = {} if gitignore_cache is None else gitignore_cache
+        rules = (self.read_gitignore(os.path.join(self.root, '.git', 'info', 'exclude'), '.git/info/exclude')
+                 + self.read_gitignore(os.path.join(self.root, '.gitignore'), '.gitignore'))
+        self.directories = {self.root: GitignoreRules(None, '', rules) if rules else None}
 
-    def is_ignored(path):
+    def read_gitignore(self, gitignore_path, label):
+        lines = self.gitignore_cache.get(gitignore_path)
+        if lines is None:
+            lines = self.gitignore_cache[gitignore_path] = read_gitignore_lines(gitignore_path)
+        return compile_gitignore(lines, label)
+
+    def relative_path(self, path):
+        rel_path = path[len(self.prefix):]
+        return rel_path.replace(os.sep, '/') if os.sep != '/' else rel_path
+
+    def rules_for(self, dir_path):
+        if dir_path in self.directories:
+            return self.directories[dir_path]
+        parent_path = os.path.dirname(dir_path) or '.'
+        if parent_path == dir_path or not dir_path.startswith(self.prefix):
+            return None  # Outside the project
+        parent = self.rules_for(parent_path)
+        rel_dir = self.relative_path(dir_path)
+        rules = self.read_gitignore(os.path.join(dir_path, '.gitignore'), f"{rel_dir}/.gitignore")
+        node = GitignoreRules(parent, rel_dir, rules) if rules else parent
+        self.directories[dir_path] = node
+        return node
+
+    def match(self, path, is_dir=None):
+        # Returns (category, rule) for the pattern ("exclude_pattern") or
+        # gitignore rule ("gitignore") that excludes `path`, or None
         path = os.path.normpath(path)
-        for pattern in patterns:
-            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
-                return True
-        return False
+        pattern = self.exclude_matcher.match(path)
+        if pattern is not None:
+            return ("exclude_pattern", pattern)
+        if path == self.root or not path.startswith(self.prefix):
+            return None
+        node = self.rules_for(os.path.dirname(path) or '.')
+        if node is None:
+            return None
+        return node.match(self.relative_path(path), path, is_dir)
+
+    def __call__(self, path, is_dir=None):
+        return self.match(path, is_dir) is not None
+
+def parse_gitignore(gitignore_path, custom_exclude_patterns):
+    return GitignoreMatcher(os.path.dirname(gitignore_path) or '.', custom_exclude_patterns)
 
-    return is_ignored
+def matches_patterns(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
 
 def should_include_file(file_path, gitignore_matcher, patterns):
-    return not gitignore_matcher(file_path) and any(fnmatch.fnmatch(os.path.basename(file_path), pattern) for pattern in patterns)
+    return not gitignore_matcher(file_path) and matches_patterns(os.path.basename(file_path), patterns)
 
-def list_directory(dir_path, prefix="", current_depth=0, max_depth=4, gitignore_matcher=None, patterns=None):
-    if current_depth > max_depth:
-        return []
+# One node of a project scan. `stat` is the cached DirEntry stat for files and
+# None for directories. A None `name` marks a directory that could not be read;
+# it sits at the depth its children would have had.
+ScanEntry = collections.namedtuple('ScanEntry', ['path', 'name', 'depth', 'is_dir', 'stat'])
+
+STATS_SLOWEST_FILES = 10
+STATS_TOP_RULES = 10
+
+class MergeStats:
+    # Counters and timings for --stats, filled in on the merging thread.
+    # `rejections` counts dropped entries per category: exclude_pattern and
+    # gitignore (with the rule in `rules`), include_patterns, node_modules and
+    # symlink directories that are listed but not entered, and, once files are
+    # read, binary, size_limit and read_error. Stage times are wall-clock
+    # seconds; "read" includes rendering and, with --tree-last, the scan.
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.rejections = collections.Counter()
+        self.rules = collections.Counter()
+        self.stages = {}
+        self.match_seconds = 0.0
+        self.slowest = []  # Min-heap of (seconds, path, bytes)
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
 
+    def timed(self, iterable, stage):
+        # Yields from `iterable`, charging the time spent producing items to `stage`
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def match(self, matcher, path, is_dir):
+        start = time.perf_counter()
+        match = matcher.match(path, is_dir)
+        self.match_seconds += time.perf_counter() - start
+        if match is not None:
+            category, rule = match
+            self.reject(category, is_dir, rule)
+        return match
+
+    def reject(self, category, is_dir, rule=None):
+        self.rejections[category] += 1
+        self.counters["dirs_pruned" if is_dir else "files_rejected"] += 1
+        if rule is not None:
+            self.rules[rule] += 1
+
+    def record_read(self, result):
+        # One FileContent from iter_file_contents
+        if result.cached is not None:
+            self.counters["cache_hits"] += 1
+            return
+        self.counters["files_read"] += 1
+        if result.error is not None:
+            self.rejections["read_error"] += 1
+        elif result.skip_reason is not None:
+            self.rejections["binary" if result.skip_reason.startswith("binary") else "skipped"] += 1
+        elif result.content is None:
+            self.rejections["size_limit"] += 1
+        size = len(result.content) if result.content is not None else 0
+        self.counters["bytes_read"] += size
+        if result.read_seconds is not None:
+            item = (result.read_seconds, result.entry.path, size)
+            if len(self.slowest) < STATS_SLOWEST_FILES:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def to_dict(self):
+        return {
+            "stages": {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            "match_seconds": round(self.match_seconds, 4),
+            "counters": dict(self.counters),
+            "rejections": dict(self.rejections),
+            "top_rules": self.rules.most_common(STATS_TOP_RULES),
+            "slowest_files": [{"path": path, "seconds": round(seconds, 4), "bytes": size}
+                              for seconds, path, size in sorted(self.slowest, reverse=True)],
+        }
+
+    def report(self):
+        stats = self.to_dict()
+        lines = ["Stages: " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in stats["stages"].items()),
+                 f"Matching: {stats['match_seconds']:.3f}s"]
+        lines.append("Counters: " + ", ".join(f"{name} {value}" for name, value in sorted(stats["counters"].items())))
+        if stats["rejections"]:
+            lines.append("Rejected: " + ", ".join(f"{name} {value}" for name, value in self.rejections.most_common()))
+        for rule, count in stats["top_rules"]:
+            lines.append(f"  {count:>8}  {rule}")
+        if stats["slowest_files"]:
+            lines.append("Slowest files:")
+            for item in stats["slowest_files"]:
+                lines.append(f"  {item['seconds'] * 1000:>8.1f} ms  {item['path']} ({item['bytes']} bytes)")
+        return "\n".join(lines)
+
+def list_project_dir(dir_path, depth, gitignore_matcher, patterns, stats=None):
+    # The entries of one directory as (entry, descend) pairs in sorted order.
+    # Excluded entries are dropped; files that do not match the include
+    # patterns are dropped, directories are kept so their contents are still
+    # reached. `descend` tells whether to scan into a directory. Pass a
+    # MergeStats as `stats` to count what is dropped and why.
     try:
-        items = os.listdir(dir_path)
+        with os.scandir(dir_path) as it:
+            children = sorted(it, key=lambda child: child.name)
     except PermissionError:
-        return [f"{prefix}[Permission Denied]"]
+        return [(ScanEntry(dir_path, None, depth, False, None), False)]
+    except OSError:
+        return []
+
+    if stats is not None:
+        stats.counters["dirs_scanned"] += 1
+    listing = []
+    for child in children:
+        try:
+            is_dir = child.is_dir()
+            if stats is not None:
+                if stats.match(gitignore_matcher, child.path, is_dir) is not None:
+                    continue
+            elif gitignore_matcher(child.path, is_dir):
+                continue
+            if is_dir:
+                # Symlinked directories are listed but not followed, like os.walk
+                descend = child.name != 'node_modules' and not child.is_symlink()
+                listing.append((ScanEntry(child.path, child.name, depth, True, None), descend))
+                if stats is not None and not descend:
+                    stats.reject("node_modules" if child.name == 'node_modules' else "symlink", True)
+            elif matches_patterns(child.name, patterns):
+                listing.append((ScanEntry(child.path, child.name, depth, False, child.stat()), False))
+                if stats is not None:
+                    stats.counters["files_matched"] += 1
+            elif stats is not None:
+                stats.reject("include_patterns", False)
+        except OSError:
+            continue
+    return listing
+
+def iter_project_entries(project_path, gitignore_matcher, patterns, stats=None):
+    # Single scandir pass over the project in sorted depth-first order, yielded
+    # one directory at a time. Excluded directories are never opened.
+    def scan(dir_path, depth):
+        for entry, descend in list_project_dir(dir_path, depth, gitignore_matcher, patterns, stats):
+            yield entry
+            if descend:
+                yield from scan(entry.path, depth + 1)
 
+    return scan(project_path, 0)
+
+def scan_project(project_path, gitignore_matcher, patterns):
+    return list(iter_project_entries(project_path, gitignore_matcher, patterns))
+
+def scan_index(project_path, gitignore_cache=None):
+    # Unfiltered scan of the whole project, in the same order and shape as
+    # scan_project, for callers that re-filter it in memory with filter_index.
+    # Only node_modules and symlinked directories are left unopened, since no
+    # filter ever descends into them. When `gitignore_cache` is given, every
+    # directory's .gitignore lines are loaded into it (empty when there is none)
+    # so matchers built on it never go back to disk.
+    entries = []
+    if gitignore_cache is not None:
+        exclude_path = os.path.join(os.path.normpath(project_path), '.git', 'info', 'exclude')
+        gitignore_cache[exclude_path] = read_gitignore_lines(exclude_path)
+
+    def scan(dir_path, depth):
+        try:
+            with os.scandir(dir_path) as it:
+                children = sorted(it, key=lambda child: child.name)
+        except PermissionError:
+            entries.append(ScanEntry(dir_path, None, depth, False, None))
+            return
+        except OSError:
+            return
+
+        if gitignore_cache is not None:
+            gitignore_path = os.path.join(os.path.normpath(dir_path), '.gitignore')
+            has_gitignore = any(child.name == '.gitignore' for child in children)
+            gitignore_cache[gitignore_path] = read_gitignore_lines(gitignore_path) if has_gitignore else []
+
+        for child in children:
+            try:
+                if child.is_dir():
+                    entries.append(ScanEntry(child.path, child.name, depth, True, None))
+                    if child.name != 'node_modules' and not child.is_symlink():
+                        scan(child.path, depth + 1)
+                else:
+                    entries.append(ScanEntry(child.path, child.name, depth, False, child.stat()))
+            except OSError:
+                continue
+
+    scan(project_path, 0)
+    return entries
+
+def filter_index(index, gitignore_matcher, patterns):
+    # The entries scan_project would return for the same matcher and patterns,
+    # computed from a scan_index result without touching the disk
+    entries = []
+    pruned_depth = None
+    for entry in index:
+        if pruned_depth is not None:
+            if entry.depth > pruned_depth:
+                continue
+            pruned_depth = None
+        if entry.name is None:
+            entries.append(entry)
+        elif gitignore_matcher(entry.path, entry.is_dir):
+            if entry.is_dir:
+                pruned_depth = entry.depth
+        elif entry.is_dir:
+            entries.append(entry)
+        elif matches_patterns(entry.name, patterns):
+            entries.append(entry)
+    return entries
+
+class ProjectTree:
+    # The filtered project kept as one listing per directory, so a change only
+    # re-lists the directories it touched (see update). entries() flattens it
+    # into the list scan_project would return.
+    def __init__(self, project_path, gitignore_matcher, patterns):
+        self.root = project_path
+        self.gitignore_matcher = gitignore_matcher
+        self.patterns = patterns
+        self.listings = {}
+        self.depths = {}
+        self.list_dir(project_path, 0)
+
+    def list_dir(self, dir_path, depth):
+        # (Re)lists one directory; subdirectories that are not listed yet are
+        # scanned in full, ones that are keep their listing
+        listing = list_project_dir(dir_path, depth, self.gitignore_matcher, self.patterns)
+        previous = self.listings.get(dir_path, [])
+        self.listings[dir_path] = listing
+        self.depths[dir_path] = depth
+        kept = {entry.path for entry, descend in listing if descend}
+        for entry, descend in previous:
+            if descend and entry.path not in kept:
+                self.forget(entry.path)
+        for entry, descend in listing:
+            if descend and entry.path not in self.listings:
+                self.list_dir(entry.path, depth + 1)
+
+    def forget(self, dir_path):
+        for entry, descend in self.listings.pop(dir_path, []):
+            if descend:
+                self.forget(entry.path)
+        self.depths.pop(dir_path, None)
+
+    def update(self, changed_dirs):
+        # Re-lists the given directories, shallowest first; directories that
+        # are gone or no longer included are skipped
+        for dir_path in sorted(changed_dirs, key=lambda path: path.count(os.sep)):
+            if dir_path in self.listings:
+                self.list_dir(dir_path, self.depths[dir_path])
+
+    def directories(self):
+        return list(self.listings)
+
+    def entries(self):
+        entries = []
+
+        def walk(dir_path):
+            for entry, descend in self.listings.get(dir_path, []):
+                entries.append(entry)
+                if descend:
+                    walk(entry.path)
+
+        walk(self.root)
+        return entries
+
+def git_ls_files(project_path):
+    # Paths of all files tracked in the git index under `project_path`, relative to it
+    result = subprocess.run(["git", "-C", project_path, "ls-files", "-z", "--cached"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return [os.fsdecode(path) for path in result.stdout.split(b"\0") if path]
+
+def scan_git_files(project_path, gitignore_matcher, patterns):
+    # Same entries as scan_project, but enumerated from the git index instead of
+    # walking the tree: untracked and ignored files never show up and only the
+    # tracked files themselves are stat'ed.
+    entries = []
+    listed_dirs = set()
+    pruned_dirs = set()
+    for parts in sorted(tuple(path.split("/")) for path in git_ls_files(project_path)):
+        pruned = False
+        for depth in range(len(parts) - 1):
+            dir_parts = parts[:depth + 1]
+            if dir_parts in pruned_dirs:
+                pruned = True
+                break
+            if dir_parts in listed_dirs:
+                continue
+            dir_path = os.path.join(project_path, *dir_parts)
+            if gitignore_matcher(dir_path):
+                pruned_dirs.add(dir_parts)
+                pruned = True
+                break
+            listed_dirs.add(dir_parts)
+            entries.append(ScanEntry(dir_path, dir_parts[-1], depth, True, None))
+            if dir_parts[-1] == 'node_modules':
+                pruned_dirs.add(dir_parts)
+                pruned = True
+                break
+        if pruned:
+            continue
+
+        file_path = os.path.join(project_path, *parts)
+        if gitignore_matcher(file_path) or not matches_patterns(parts[-1], patterns):
+            continue
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue  # Tracked but deleted from the working tree
+        if stat.S_ISDIR(st.st_mode):
+            continue  # Submodule
+        entries.append(ScanEntry(file_path, parts[-1], len(parts) - 1, False, st))
+    return entries
+
+def render_structure(entries, patterns, max_depth):
     structure = []
-    for item in sorted(items):
-        item_path = os.path.join(dir_path, item)
-        if should_include_file(item_path, gitignore_matcher, patterns):
-            structure.append(f"{prefix}{item}")
-            if os.path.isdir(item_path) and item != 'node_modules':  # Explicitly skip node_modules
-                structure.extend(list_directory(item_path, prefix + "│   ", current_depth + 1, max_depth, gitignore_matcher, patterns))
+    hidden_depth = None
+    for entry in entries:
+        if hidden_depth is not None:
+            if entry.depth > hidden_depth:
+                continue
+            hidden_depth = None
+        if entry.depth > max_depth:
+            continue
+        prefix = "│   " * entry.depth
+        if entry.name is None:
+            structure.append(f"{prefix}[Permission Denied]")
+        elif entry.is_dir and not matches_patterns(entry.name, patterns):
+            # A directory that fails the include patterns hides its whole subtree
+            hidden_depth = entry.depth
+        else:
+            structure.append(f"{prefix}{entry.name}")
     return structure
 
+def project_files(entries):
+    return [entry for entry in entries if entry.stat is not None]
+
 def get_file_extension(file_path):
     return os.path.splitext(file_path)[1][1:]
 
-def append_file_content(file_path, output_file, max_size_kb):
-    file_size_kb = os.path.getsize(file_path) / 1024
-    if file_size_kb <= max_size_kb:
-        with open(output_file, "a", encoding="utf-8") as out, open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            out.write(f"\n\n## File: {file_path}\n\n")
-            out.write(f"```{get_file_extension(file_path)}\n")
-            out.write(f.read())
-            out.write("\n```\n")
+# Language names for structured output; other files report their extension
+LANGUAGES = {
+    'py': 'python', 'pyi': 'python', 'js': 'javascript', 'jsx': 'javascript', 'mjs': 'javascript',
+    'ts': 'typescript', 'tsx': 'typescript', 'go': 'go', 'rs': 'rust', 'java': 'java', 'kt': 'kotlin',
+    'c': 'c', 'h': 'c', 'cc': 'cpp', 'cpp': 'cpp', 'hpp': 'cpp', 'cs': 'csharp', 'rb': 'ruby',
+    'php': 'php', 'swift': 'swift', 'sh': 'shell', 'bash': 'shell', 'md': 'markdown', 'html': 'html',
+    'css': 'css', 'scss': 'scss', 'json': 'json', 'yml': 'yaml', 'yaml': 'yaml', 'toml': 'toml',
+    'xml': 'xml', 'sql': 'sql',
+}
+
+def file_language(file_path):
+    extension = get_file_extension(file_path).lower()
+    return LANGUAGES.get(extension, extension)
+
+def render_header(max_depth, max_size, patterns, structure, contents_heading="# File Contents", extra_config=()):
+    # With structure=None the folder structure goes after the contents instead
+    # (see render_structure_footer), so the header needs no scan at all
+    if structure is None:
+        outline = "1. Contents of relevant files\n2. Project folder structure\n\n"
+    else:
+        outline = "1. Project folder structure\n2. Contents of relevant files\n\n"
+    header = (
+        "# Project Knowledge for AI Analysis\n\n"
+        "This markdown file contains the structure and contents of a project. "
+        "It is organized as follows:\n\n"
+        + outline +
+        "---\n\n"
+        "## Project Configuration\n\n"
+        f"- Max directory depth: {max_depth}\n"
+        f"- Max file size: {max_size}KB\n"
+        f"- File patterns included: {', '.join(patterns)}\n"
+        + "".join(f"- {line}\n" for line in extra_config) + "\n"
+        "---\n\n"
+    )
+    if structure is not None:
+        header += "## Project Folder Structure\n\n" + "\n".join(structure) + "\n\n"
+    return (header + f"{contents_heading}\n").encode("utf-8")
+
+def render_structure_footer(structure):
+    return ("\n\n---\n\n## Project Folder Structure\n\n" + "\n".join(structure) + "\n").encode("utf-8")
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class Compressor:
+    # One compressed stream. `sync` returns everything compressed so far in a
+    # form a reader can decode up to this point (empty for codecs that cannot
+    # do that); `finish` ends the stream.
+    def __init__(self, name, extension, compress, sync, finish):
+        self.name = name
+        self.extension = extension
+        self.compress = compress
+        self.sync = sync
+        self.finish = finish
+
+def gzip_compressor(level=None):
+    c = zlib.compressobj(int(level or 6), zlib.DEFLATED, 31)  # wbits 31: gzip framing
+    return Compressor("gzip", ".gz", c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush)
+
+def xz_compressor(level=None):
+    c = lzma.LZMACompressor(preset=int(level or 6))
+    return Compressor("xz", ".xz", c.compress, lambda: b"", c.flush)
+
+def zstd_compressor(level=None):
+    c = zstandard.ZstdCompressor(level=int(level or 3)).compressobj()
+    return Compressor("zstd", ".zst", c.compress, lambda: c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), c.flush)
+
+# Output codecs by name; the spec "NAME:LEVEL" passes LEVEL to the factory
+COMPRESSORS = {
+    "gzip": gzip_compressor,
+    "xz": xz_compressor,
+    "zstd": zstd_compressor,
+}
+
+def get_compressor(spec):
+    name, _, level = spec.partition(":")
+    if name not in COMPRESSORS:
+        raise ValueError(f"Unknown compression '{name}' (available: {', '.join(sorted(COMPRESSORS))})")
+    if name == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    if level and not level.isdigit():
+        raise ValueError(f"Invalid compression level '{level}'")
+    return COMPRESSORS[name](level or None)
+
+COMPRESS_CHUNK_SIZE = 256 * 1024  # Writes are batched into chunks of this size for the compressor
+COMPRESS_QUEUE_CHUNKS = 16  # Chunks waiting for the compressor thread before writers block
+
+class CompressedFile:
+    # Binary file-like object that compresses everything written to it into
+    # `raw`. Writes are batched into COMPRESS_CHUNK_SIZE chunks. With
+    # threaded=True the compressor runs on its own thread behind a bounded
+    # queue, so the writer only waits when the compressor falls
+    # COMPRESS_QUEUE_CHUNKS chunks behind, or on close. `raw` is closed with
+    # it when owns_raw is set, otherwise only flushed.
+    SYNC = object()
+
+    def __init__(self, raw, compressor, threaded=False, owns_raw=True):
+        self.raw = raw
+        self.compressor = compressor
+        self.owns_raw = owns_raw
+        self.chunk = []
+        self.chunk_size = 0
+        self.error = None
+        self.queue = None
+        if threaded:
+            self.queue = queue.Queue(maxsize=COMPRESS_QUEUE_CHUNKS)
+            self.thread = threading.Thread(target=self.run, name="aicodemerge-compress", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.apply(item)
+                except Exception as e:
+                    self.error = e  # Raised on the writer's thread by the next call
+            self.queue.task_done()
+
+    def apply(self, item):
+        if item is CompressedFile.SYNC:
+            self.raw.write(self.compressor.sync())
+            self.raw.flush()
+        else:
+            self.raw.write(self.compressor.compress(item))
+
+    def submit(self, item):
+        if self.queue is None:
+            self.apply(item)
+            return
+        self.check()
+        self.queue.put(item)
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit_chunk(self):
+        if self.chunk:
+            self.submit(b"".join(self.chunk))
+            self.chunk = []
+            self.chunk_size = 0
+
+    def write(self, data):
+        self.chunk.append(data)
+        self.chunk_size += len(data)
+        if self.chunk_size >= COMPRESS_CHUNK_SIZE:
+            self.submit_chunk()
+        return len(data)
+
+    def flush(self):
+        # Queues a sync point; with a thread it is written once the compressor
+        # gets there, so flushing never waits for it (close() does)
+        self.submit_chunk()
+        self.submit(CompressedFile.SYNC)
+
+    def close(self):
+        self.submit_chunk()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+        try:
+            self.check()
+            self.raw.write(self.compressor.finish())
+        finally:
+            if self.owns_raw:
+                self.raw.close()
+            else:
+                self.raw.flush()
+
+class OutputWriter:
+    # Keeps the output file open for the whole run behind one large buffer so
+    # per-file sections coalesce into few write syscalls. With record_layout the
+    # (name, length, digest) of every block is kept so a later --incremental run
+    # can tell which part of the file is still valid. With `compression` (a
+    # get_compressor spec) the output is compressed on the fly; bytes_written
+    # and the layout still count uncompressed bytes.
+    def __init__(self, output_file, buffer_size=OUTPUT_BUFFER_SIZE, record_layout=False,
+                 compression=None, compress_threaded=False):
+        self.output_file = output_file
+        self.buffer_size = buffer_size
+        self.record_layout = record_layout
+        self.compression = compression
+        self.compress_threaded = compress_threaded
+        self.layout = []
+        self.bytes_written = 0
+        self.file = self.open()
+
+    def open(self):
+        return self.compress(open(self.output_file, "wb", buffering=self.buffer_size))
+
+    def compress(self, raw, owns_raw=True):
+        if self.compression is None:
+            return raw
+        return CompressedFile(raw, get_compressor(self.compression), self.compress_threaded, owns_raw)
+
+    def write(self, text):
+        self.write_bytes(text.encode("utf-8"))
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def write_block(self, name, data, digest=None):
+        # A named unit of output: the header or one file section
+        if self.record_layout:
+            self.layout.append((name, len(data), digest or block_digest(data)))
+        self.write_bytes(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class StreamOutputWriter(OutputWriter):
+    # Writes to an already open binary stream such as sys.stdout.buffer and
+    # flushes after every block, so a reader at the other end of a pipe gets
+    # each section as soon as it is rendered. The stream is not closed.
+    def __init__(self, stream, record_layout=False, compression=None, compress_threaded=False):
+        self.stream = stream
+        super().__init__("-", record_layout=record_layout, compression=compression,
+                         compress_threaded=compress_threaded)
+
+    def open(self):
+        return self.compress(self.stream, owns_raw=False)
+
+    def write_block(self, name, data, digest=None):
+        super().write_block(name, data, digest)
+        self.file.flush()
+
+    def close(self):
+        if self.compression is not None:
+            self.file.close()  # Ends the compressed stream; the stream itself stays open
+        else:
+            self.file.flush()
+
+class PatchingOutputWriter(OutputWriter):
+    # Rewrites an existing output in place. Leading blocks identical to the
+    # previous layout are skipped; the file is opened, truncated and rewritten
+    # from the first block that differs.
+    def __init__(self, output_file, previous_layout, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.previous_layout = previous_layout
+        self.bytes_reused = 0
+        super().__init__(output_file, buffer_size, record_layout=True)
+
+    def open(self):
+        return None
+
+    def diverge(self):
+        self.file = open(self.output_file, "r+b", buffering=self.buffer_size)
+        self.file.seek(self.bytes_reused)
+        self.file.truncate()
+
+    def write_bytes(self, data):
+        if self.file is None:
+            self.diverge()
+        super().write_bytes(data)
+
+    def write_block(self, name, data, digest=None):
+        if self.file is None:
+            digest = block_digest(data)
+            index = len(self.layout)
+            block = (name, len(data), digest)
+            if index < len(self.previous_layout) and self.previous_layout[index] == block:
+                self.layout.append(block)
+                self.bytes_reused += len(data)
+                return
+            self.diverge()
+        super().write_block(name, data, digest)
+
+    def close(self):
+        if self.file is None:
+            # Nothing changed except possibly trailing blocks that are gone now
+            self.diverge()
+        super().close()
+
+PACK_MAGIC = b"AICMPACK"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<8sIIQQ")  # magic, version, file count, index offset, index length
+
+class PackOutputWriter(OutputWriter):
+    # Packed container for programs: a fixed PACK_HEADER, the content of every
+    # file back to back, then a JSON index {"files": [{path, offset, length,
+    # hash, language}, ...]}. The header points at the index, so a reader can
+    # mmap the file, load the index once and slice out any file in O(1) (see
+    # PackReader). Blocks are raw file contents named by path; identical
+    # contents are stored once. The header is patched on close, so the output
+    # must be a seekable, uncompressed file.
+    def __init__(self, output_file, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.files = []
+        self.offsets = {}
+        super().__init__(output_file, buffer_size)
+        self.write_bytes(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, 0, 0, 0))
+
+    def write_block(self, name, data, digest=None):
+        if not name:
+            return  # The markdown header has no place in a pack
+        digest = content_hash(data)
+        offset = self.offsets.get(digest)
+        if offset is None:
+            offset = self.offsets[digest] = self.bytes_written
+            self.write_bytes(data)
+        self.files.append({"path": name, "offset": offset, "length": len(data), "hash": digest,
+                           "language": file_language(name)})
+
+    def close(self):
+        index_offset = self.bytes_written
+        index = json.dumps({"files": self.files}, ensure_ascii=False).encode("utf-8")
+        self.write_bytes(index)
+        self.file.seek(0)
+        self.file.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(self.files), index_offset, len(index)))
+        super().close()
+
+class PackReader:
+    # Random access to a file written by PackOutputWriter. The container is
+    # mmapped, so read() only touches the pages of the file asked for.
+    #
+    #     with PackReader("project.pack") as pack:
+    #         source = pack.read("project/src/main.py").decode("utf-8")
+    def __init__(self, pack_file):
+        with open(pack_file, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _count, index_offset, index_length = PACK_HEADER.unpack_from(self.mmap)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            self.mmap.close()
+            raise ValueError(f"{pack_file} is not an aicodemerge pack (version {PACK_VERSION})")
+        index = json.loads(self.mmap[index_offset:index_offset + index_length])
+        self.files = {item["path"]: item for item in index["files"]}
+
+    def read(self, path):
+        item = self.files[path]
+        return self.mmap[item["offset"]:item["offset"] + item["length"]]
+
+    def close(self):
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+BINARY_SNIFF_SIZE = 8192
+BINARY_TEXT_RATIO = 0.3
+BINARY_MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'PNG image'), (b'GIF87a', 'GIF image'), (b'GIF89a', 'GIF image'),
+    (b'\xff\xd8\xff', 'JPEG image'), (b'%PDF-', 'PDF document'), (b'PK\x03\x04', 'ZIP archive'),
+    (b'\x1f\x8b', 'gzip archive'), (b'\xfd7zXZ\x00', 'xz archive'), (b'7z\xbc\xaf\x27\x1c', '7z archive'),
+    (b'\x7fELF', 'ELF binary'), (b'\xca\xfe\xba\xbe', 'Java class or Mach-O binary'),
+    (b'\xcf\xfa\xed\xfe', 'Mach-O binary'), (b'\xce\xfa\xed\xfe', 'Mach-O binary'),
+    (b'\x00asm', 'WebAssembly module'), (b'SQLite format 3\x00', 'SQLite database'),
+]
+UNICODE_BOMS = (b'\xff\xfe', b'\xfe\xff', b'\x00\x00\xfe\xff')
+# Longest first, so the UTF-32 LE BOM is not taken for the UTF-16 LE one
+BOM_ENCODINGS = [
+    (b'\x00\x00\xfe\xff', 'utf-32-be'), (b'\xff\xfe\x00\x00', 'utf-32-le'), (b'\xef\xbb\xbf', 'utf-8'),
+    (b'\xfe\xff', 'utf-16-be'), (b'\xff\xfe', 'utf-16-le'),
+]
+BOM_PREFIXES = tuple(bom for bom, _ in BOM_ENCODINGS)
+# Tried in order for files that are not valid UTF-8; latin-1 decodes anything
+LEGACY_ENCODINGS = ('cp1252', 'latin-1')
+# Bytes that show up in text files: printable ASCII, common whitespace and
+# escape, and everything >= 0x80 (UTF-8 sequences and legacy 8-bit encodings).
+TEXT_BYTES = bytes(sorted({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x7f)) | set(range(0x80, 0x100))))
+
+def sniff_binary(head):
+    # Returns why `head` (the first bytes of a file) looks binary, or None for text.
+    for magic, kind in BINARY_MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return kind
+    if head.startswith(UNICODE_BOMS):
+        return None
+    if b'\x00' in head:
+        return None if guess_utf16(head) is not None else 'NUL byte'
+    if head and len(head.translate(None, TEXT_BYTES)) / len(head) > BINARY_TEXT_RATIO:
+        return 'non-text bytes'
+    return None
+
+def guess_utf16(head):
+    # Byte order of BOM-less UTF-16, recognised by the NUL in every other byte
+    # that mostly-ASCII text has; None for anything else
+    half = len(head) // 2
+    if half < 2:
+        return None
+    even_nuls = head[0::2].count(0)
+    odd_nuls = head[1::2].count(0)
+    if odd_nuls >= 0.9 * half and even_nuls <= 0.1 * half:
+        return 'utf-16-le'
+    if even_nuls >= 0.9 * half and odd_nuls <= 0.1 * half:
+        return 'utf-16-be'
+    return None
+
+def normalize_newlines(data):
+    # CRLF and lone CR to LF on UTF-8 bytes; 0x0D never occurs inside a multi-byte sequence
+    if b"\r" not in data:
+        return data
+    return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+def decode_file_bytes(data):
+    # UTF-8 output bytes with LF line endings for a source file. Valid UTF-8
+    # (checked by the decoder's fast path) is passed through without a
+    # decode/encode round trip, minus a UTF-8 BOM. A BOM selects UTF-16/32,
+    # BOM-less UTF-16 is recognised by its NUL pattern, and anything else that
+    # is not UTF-8 is read as cp1252, or latin-1 when that fails, so no
+    # character is lost.
+    if data.startswith(BOM_PREFIXES):
+        for bom, encoding in BOM_ENCODINGS:
+            if data.startswith(bom):
+                break
+        data = data[len(bom):]
+        if encoding != 'utf-8':
+            return normalize_newlines(data.decode(encoding, errors="replace").encode("utf-8"))
+    if b'\x00' in data:
+        encoding = guess_utf16(data[:BINARY_SNIFF_SIZE])
+        if encoding is not None:
+            return normalize_newlines(data.decode(encoding, errors="replace").encode("utf-8"))
+    if data.isascii():
+        return normalize_newlines(data)
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        for encoding in LEGACY_ENCODINGS:
+            try:
+                return normalize_newlines(data.decode(encoding).encode("utf-8"))
+            except UnicodeDecodeError:
+                continue
+    return normalize_newlines(data)
+
+MMAP_MIN_SIZE = 256 * 1024  # Smaller files are cheaper to read() than to map
+
+# Keeps files over the size limit in the output as their first and last
+# `window` bytes (whole lines), with a note of how much was left out in
+# between. With skeleton, the def/class signatures and docstrings of the left
+# out part of Python files are listed too.
+Truncation = collections.namedtuple('Truncation', ['window', 'skeleton'])
+
+def is_truncated(file_size, max_size_kb, truncation):
+    # Whether load_file_content keeps only the head and tail of a file this size
+    return (truncation is not None and file_size / 1024 > max_size_kb
+            and file_size > 2 * truncation.window)  # Otherwise the windows hold all of it
+
+SKELETON_SCAN_LIMIT = 16 * 1024 * 1024  # Bytes of the elided part scanned for the skeleton
+SKELETON_SIGNATURE_LINES = 10
+SKELETON_DOCSTRING_LINES = 20
+SKELETON_DEF = re.compile(rb"^[ \t]*(?:async[ \t]+)?(?:def|class)[ \t]+\w", re.M)
+DOCSTRING_START = re.compile(rb"[ \t]*[rRuUbB]?(\"\"\"|\'\'\')")
+
+def python_skeleton(data, limit):
+    # Signature lines (with decorators) and docstrings of every def and class
+    # in `data`, at most `limit` bytes; the flag tells whether all of them fit
+    lines = data.split(b"\n")
+    out = []
+    size = 0
+    line_no = 0
+    offset = 0
+    for match in SKELETON_DEF.finditer(data):
+        line_no += data.count(b"\n", offset, match.start())
+        offset = match.start()
+        first = line_no
+        while first > 0 and lines[first - 1].lstrip().startswith(b"@"):
+            first -= 1
+        # The signature ends at the first line with a ':' outside parentheses
+        last = line_no
+        depth = 0
+        while True:
+            code = lines[last].split(b"#", 1)[0]
+            depth += code.count(b"(") + code.count(b"[") - code.count(b")") - code.count(b"]")
+            if (depth <= 0 and b":" in code) or last - line_no >= SKELETON_SIGNATURE_LINES or last + 1 >= len(lines):
+                break
+            last += 1
+        block = lines[first:last + 1]
+        body = last + 1
+        while body < len(lines) and not lines[body].strip():
+            body += 1
+        docstring = DOCSTRING_START.match(lines[body]) if body < len(lines) else None
+        if docstring is not None:
+            quote = docstring.group(1)
+            end = body
+            if lines[body].count(quote) < 2:
+                end += 1
+                while end < len(lines) and quote not in lines[end] and end - body < SKELETON_DOCSTRING_LINES:
+                    end += 1
+            block.extend(lines[body:min(end, len(lines) - 1) + 1])
+        text = b"\n".join(block) + b"\n"
+        if size + len(text) > limit:
+            return b"".join(out), False
+        out.append(text)
+        size += len(text)
+    return b"".join(out), True
+
+def read_truncated(f, file_size, head, truncation, language):
+    # Head and tail windows of an oversized file via seek, so the cost does not
+    # depend on the file's size. `head` holds the bytes already read from the
+    # start of `f`. Returns the decoded content with an elision note. Windows
+    # are cut to whole lines: on the raw bytes for 8-bit and UTF-8 files, where
+    # a cut line would also break a character, and after decoding for UTF-16/32.
+    # A window without a usable newline (minified code, data files) is cut at
+    # a UTF-8 lead byte instead, like split_section does.
+    window = truncation.window
+    if len(head) <= window:
+        head += f.read(window + 1 - len(head))  # One byte more, to see what follows the cut
+    bom, encoding = next(((bom, encoding) for bom, encoding in BOM_ENCODINGS
+                          if head.startswith(bom) and encoding != 'utf-8'), (b"", None))
+    end = min(len(head), window)
+    if bom:
+        unit = 4 if encoding.startswith('utf-32') else 2
+        end -= (end - len(bom)) % unit
+    else:
+        newline = head.rfind(b"\n", 0, end)
+        if newline != -1:
+            end = newline + 1
+        else:
+            while 0 < end < len(head) and 0x80 <= head[end] < 0xc0:
+                end -= 1  # Do not cut a UTF-8 sequence
+    head = head[:end]
+    head_end = len(head)
+
+    tail_start = max(file_size - window, head_end)
+    tail_start += -(tail_start - len(bom)) % 4 if bom else 0  # Whole code units
+    f.seek(tail_start)
+    tail = f.read(window)
+    if not bom and tail_start > head_end:
+        # Drop the partial first line, unless nothing would be left after it
+        newline = tail.find(b"\n")
+        if newline != -1 and newline + 1 < len(tail):
+            skip = newline + 1
+        else:
+            skip = 0
+            while skip < min(len(tail), 3) and 0x80 <= tail[skip] < 0xc0:
+                skip += 1  # Start at a UTF-8 lead byte
+        tail_start += skip
+        tail = tail[skip:]
+
+    elided = tail_start - head_end
+    notes = [f"[... {elided:,} of {file_size:,} bytes elided ...]\n".encode("utf-8")]
+    if truncation.skeleton and language == 'python' and not bom and elided > 0:
+        f.seek(head_end)
+        scanned = min(elided, SKELETON_SCAN_LIMIT)
+        skeleton, complete = python_skeleton(f.read(scanned), window)
+        if skeleton:
+            covered = "" if complete and scanned == elided else " (partial)"
+            notes = [f"[... {elided:,} of {file_size:,} bytes elided; their definitions{covered}: ...]\n".encode("utf-8"),
+                     skeleton, b"[... end of elided definitions ...]\n"]
+    head = decode_file_bytes(head)
+    tail = decode_file_bytes(bom + tail)
+    if bom and elided > 0:
+        head = head[:head.rfind(b"\n") + 1] or head
+        tail = tail[tail.find(b"\n") + 1:] or tail
+    if head and not head.endswith(b"\n"):
+        head += b"\n"
+    return head + b"".join(notes) + tail
+
+def load_file_content(file_path, max_size_kb, file_size=None, truncation=None):
+    # Returns (size, content bytes, skip reason). Only the first BINARY_SNIFF_SIZE
+    # bytes are read before deciding to skip a binary file. Content is None when
+    # the file is skipped or over the size limit; with a Truncation, files
+    # over the limit get their head and tail instead (see read_truncated), or
+    # all of it when the two windows would cover the whole file.
+    # Files of at least MMAP_MIN_SIZE are mapped, so the content is copied
+    # out of the page cache once instead of being read and then joined to
+    # the sniffed head.
+    if file_size is None:
+        file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        head = f.read(BINARY_SNIFF_SIZE)
+        kind = sniff_binary(head)
+        if kind is not None:
+            return file_size, None, f"binary file ({kind})"
+        if is_truncated(file_size, max_size_kb, truncation):
+            return file_size, read_truncated(f, file_size, head, truncation, file_language(file_path)), None
+        if file_size / 1024 > max_size_kb and truncation is None:
+            return file_size, None, None
+        data = None
+        if file_size >= MMAP_MIN_SIZE:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = mapped[:]
+            except (ValueError, OSError):
+                pass  # Emptied since the scan, or not mappable; read it instead
+        if data is None:
+            data = head + f.read()
+    return file_size, decode_file_bytes(data), None
+
+SECTION_TAIL = b"\n```\n"
+
+def render_section_head(file_path, label=""):
+    return f"\n\n## File: {file_path}{label}\n\n```{get_file_extension(file_path)}\n".encode("utf-8")
+
+def render_file_section(file_path, content, file_size, max_size_kb):
+    if content is None:
+        return (f"\n\n## File: {file_path}\n\n"
+                f"File exceeds size limit ({file_size / 1024:.2f}KB > {max_size_kb}KB). Content not included.\n").encode("utf-8")
+    return b"".join([render_section_head(file_path), content, SECTION_TAIL])
+
+def content_hash(data):
+    # Fast content fingerprint, prefixed with the algorithm so hashes stored by
+    # a run with xxhash installed never compare equal to blake2b ones
+    if xxhash is not None:
+        return "xxh3:" + xxhash.xxh3_128_hexdigest(data)
+    return "blake2b:" + hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# Result of reading one scanned file. `skip_reason` is set when the file is left
+# out of the output entirely (e.g. binaries); `error` holds the OSError raised
+# while reading it. `content_hash` is only computed when asked for. `cached`
+# holds the lookup result for files that were not read (see iter_file_contents).
+# `read_seconds` is the time spent reading, decoding and hashing the file.
+FileContent = collections.namedtuple('FileContent', ['entry', 'size', 'content', 'skip_reason', 'error', 'content_hash', 'cached',
+                                                     'read_seconds'], defaults=(None, None))
+
+READ_AHEAD_FILES_PER_JOB = 8
+READ_AHEAD_BYTES = 64 * 1024 * 1024
+
+def iter_file_contents(files, max_size_kb, jobs=1, hash_sizes=(), lookup=None, executor=None, truncation=None):
+    # Yields a FileContent for each file in input order; `files` may be any
+    # iterable and is consumed lazily. With jobs > 1 files are read on a thread
+    # pool; at most READ_AHEAD_FILES_PER_JOB files per worker and
+    # READ_AHEAD_BYTES of content are in flight, so one slow file holds back the
+    # output but never lets the rest pile up in memory. Files whose size is in
+    # `hash_sizes` (every file when it is None) get their content hashed on the
+    # worker thread. `lookup(entry)` runs on the caller's thread before a file
+    # is read; when it returns something, the file is not read and the result
+    # is passed through as `cached`. Pass `executor` to read on a shared thread
+    # pool instead of a private one; `jobs` still sizes the read-ahead. With a
+    # Truncation, files over the limit are read in part and never hashed.
+    def load(entry):
+        start = time.perf_counter()
+        try:
+            file_size, content, skip_reason = load_file_content(entry.path, max_size_kb, entry.stat.st_size, truncation)
+        except OSError as e:
+            return FileContent(entry, entry.stat.st_size, None, None, e, None, None, time.perf_counter() - start)
+        hashed = (content is not None and not is_truncated(file_size, max_size_kb, truncation)
+                  and (hash_sizes is None or file_size in hash_sizes))
+        digest = content_hash(content) if hashed else None
+        return FileContent(entry, file_size, content, skip_reason, None, digest, None, time.perf_counter() - start)
+
+    def check(entry):
+        hit = lookup(entry) if lookup is not None else None
+        return None if hit is None else FileContent(entry, entry.stat.st_size, None, None, None, None, hit)
+
+    if jobs <= 1:
+        for entry in files:
+            yield check(entry) or load(entry)
+        return
+
+    max_pending = jobs * READ_AHEAD_FILES_PER_JOB
+    private_executor = None
+    if executor is None:
+        executor = private_executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        pending = collections.deque()
+        pending_bytes = 0
+        remaining = iter(files)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending and (not pending or pending_bytes < READ_AHEAD_BYTES):
+                entry = next(remaining, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                hit = check(entry)
+                if hit is not None:
+                    pending.append((0, hit))
+                    continue
+                if entry.stat.st_size / 1024 <= max_size_kb:
+                    expected = entry.stat.st_size
+                else:
+                    expected = 2 * truncation.window if truncation is not None else 0
+                pending.append((expected, executor.submit(load, entry)))
+                pending_bytes += expected
+            if not pending:
+                break
+            expected, future = pending.popleft()
+            pending_bytes -= expected
+            yield future if isinstance(future, FileContent) else future.result()
+    finally:
+        # A consumer that stops early leaves reads behind; drop the ones not started
+        for _, future in pending:
+            if not isinstance(future, FileContent):
+                future.cancel()
+        if private_executor is not None:
+            private_executor.shutdown(wait=True)
+
+def parse_size(text):
+    # '500K', '10M', '1G' (binary units) or a plain byte count
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def split_section(file_path, section, budget, cost):
+    # Cuts one fenced file section into parts that each cost at most about
+    # `budget`, breaking at line ends where possible. Every part is a complete
+    # fenced block labelled "(part i/n)".
+    head = render_section_head(file_path)
+    if not (section.startswith(head) and section.endswith(SECTION_TAIL)):
+        return [section]
+    content = section[len(head):len(section) - len(SECTION_TAIL)]
+    overhead = len(render_section_head(file_path, " (part 9999/9999)")) + len(SECTION_TAIL)
+    bytes_per_unit = len(section) / max(cost(section), 1)
+    piece_size = max(int(budget * bytes_per_unit) - overhead, 1)
+
+    pieces = []
+    start = 0
+    while start < len(content):
+        end = min(start + piece_size, len(content))
+        if end < len(content):
+            newline = content.rfind(b"\n", start, end)
+            if newline > start:
+                end = newline + 1
+            else:
+                while end > start + 1 and 0x80 <= content[end] < 0xc0:
+                    end -= 1  # Do not cut a UTF-8 sequence
+        pieces.append(content[start:end])
+        start = end
+    return [render_section_head(file_path, f" (part {i}/{len(pieces)})") + piece + SECTION_TAIL
+            for i, piece in enumerate(pieces, 1)]
+
+def shard_file_name(output_file, index):
+    root, ext = os.path.splitext(output_file)
+    return f"{root}_part{index:03d}{ext}"
+
+def shard_manifest_name(output_file):
+    return f"{os.path.splitext(output_file)[0]}_manifest.json"
+
+MIN_SHARD_CONTENT = 256  # Bytes of file content every shard must have room for
+
+def min_shard_limit(render_shard_header, cost):
+    # The limit a shard needs for its header plus a section part holding
+    # MIN_SHARD_CONTENT bytes; below it files would be cut into a part per line
+    section = render_section_head("file", " (part 9999/9999)") + b"x" * MIN_SHARD_CONTENT + SECTION_TAIL
+    return cost(render_shard_header([], 999)) + cost(section)
+
+class ShardedOutputWriter:
+    # Drop-in for OutputWriter that streams sections into numbered shard files
+    # of at most `limit` bytes or tokens, as measured by `cost`. Each shard is
+    # self-contained: render_shard_header(structure_entries, part) gives it a
+    # header listing only the folders and files it holds. Sections are buffered
+    # until a shard is full, so memory is bounded by one shard, and a file is
+    # only cut into parts when it does not fit in an empty shard. A JSON
+    # manifest maps files to shards. With `compression` every shard is
+    # compressed on its own; the limit applies to the uncompressed text.
+    def __init__(self, output_file, limit, cost, unit, render_shard_header, entries,
+                 compression=None, compress_threaded=False):
+        self.output_file = output_file
+        self.compression = compression
+        self.compress_threaded = compress_threaded
+        self.limit = limit
+        self.cost = cost
+        self.unit = unit
+        self.render_shard_header = render_shard_header
+        self.dirs = {entry.path: entry for entry in entries if entry.is_dir}
+        self.files = {entry.path: entry for entry in entries if entry.stat is not None}
+        self.header_cost = cost(render_shard_header([], 999))
+        self.shards = []
+        self.bytes_written = 0
+        self.start_shard()
+
+    def start_shard(self):
+        self.structure = []
+        self.listed = set()
+        self.blocks = []
+        self.shard_files = []
+        self.used = self.header_cost
+
+    def new_structure(self, entry):
+        # Entries (the file and any ancestors) that adding `entry` would add to
+        # this shard's folder structure, and what they cost
+        new = [entry]
+        path = os.path.dirname(entry.path)
+        while path in self.dirs and path not in self.listed:
+            new.append(self.dirs[path])
+            path = os.path.dirname(path)
+        new.reverse()
+        return new, sum(self.cost(f"{'│   ' * e.depth}{e.name}\n".encode("utf-8")) for e in new)
+
+    def write_block(self, name, data, digest=None):
+        if name == "":
+            return  # The single-file header is replaced by one header per shard
+        entry = self.files.get(name)
+        if entry is None:
+            self.blocks.append(data)  # Trailing blocks such as the omitted-files list
+            self.used += self.cost(data)
+            return
+
+        new, structure_cost = self.new_structure(entry)
+        data_cost = self.cost(data)
+        if self.shard_files and self.used + structure_cost + data_cost > self.limit:
+            self.flush()
+            new, structure_cost = self.new_structure(entry)
+        parts = [data]
+        if self.used + structure_cost + data_cost > self.limit:
+            parts = split_section(entry.path, data, self.limit - self.used - structure_cost, self.cost)
+        for i, part in enumerate(parts):
+            if i > 0:
+                self.flush()
+                new, structure_cost = self.new_structure(entry)
+            self.structure.extend(new)
+            self.listed.update(e.path for e in new)
+            self.blocks.append(part)
+            self.shard_files.append(entry.path)
+            self.used += structure_cost + self.cost(part)
+
+    def flush(self):
+        if not self.blocks and self.shards:
+            return
+        part = len(self.shards) + 1
+        shard_file = shard_file_name(self.output_file, part)
+        if self.compression is not None:
+            shard_file += get_compressor(self.compression).extension
+        with OutputWriter(shard_file, compression=self.compression, compress_threaded=self.compress_threaded) as out:
+            out.write_block("", self.render_shard_header(self.structure, part))
+            for block in self.blocks:
+                out.write_block("", block)
+        self.bytes_written += out.bytes_written
+        self.shards.append({"file": shard_file, "bytes": out.bytes_written, "files": self.shard_files})
+        self.start_shard()
+
+    def close(self):
+        self.flush()
+        files = {}
+        for index, shard in enumerate(self.shards):
+            for path in shard["files"]:
+                files.setdefault(path, []).append(index)
+        manifest = {"output": self.output_file, "limit": self.limit, "unit": self.unit,
+                    "shards": self.shards, "files": files}
+        with open(shard_manifest_name(self.output_file), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "aicodemerge")
+
+# Bump when the rendering of file sections changes so stale cache rows are ignored
+SECTION_FORMAT_VERSION = 2
+# Bump when the cache tables change; older cache files are then rebuilt
+CACHE_SCHEMA_VERSION = 2
+# Files modified this recently are not cached: a second write within the same
+# mtime tick that keeps the size would otherwise go unnoticed
+CACHE_RACY_WINDOW_NS = 2 * 10**9
+
+class MergeCache:
+    # SQLite cache of rendered file sections for one project, keyed by path and
+    # validated against mtime, size and inode. It also remembers the block layout
+    # of each output file written from this project for --incremental runs.
+    def __init__(self, cache_file):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self.cache_file = cache_file
+        self.db = sqlite3.connect(cache_file)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+            for table in ("sections", "outputs", "tokens"):
+                self.db.execute(f"DROP TABLE IF EXISTS {table}")
+            self.db.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sections (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+                        "inode INTEGER, options TEXT, section BLOB, skip_reason TEXT, content_hash TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outputs (output_path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                        "size INTEGER, layout TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tokens (path TEXT, counter TEXT, mtime_ns INTEGER, size INTEGER, "
+                        "inode INTEGER, options TEXT, tokens INTEGER, PRIMARY KEY (path, counter))")
+        self.keys = {row[0]: tuple(row[1:]) for row in self.db.execute(
+            "SELECT path, mtime_ns, size, inode, options FROM sections")}
+        self.token_counts = {(row[0], row[1]): (tuple(row[2:6]), row[6]) for row in self.db.execute(
+            "SELECT path, counter, mtime_ns, size, inode, options, tokens FROM tokens")}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_project(cls, project_path, cache_dir=None):
+        project_path = os.path.abspath(project_path)
+        project_id = hashlib.sha1(project_path.encode("utf-8")).hexdigest()[:12]
+        name = f"{os.path.basename(project_path)}-{project_id}.sqlite3"
+        return cls(os.path.join(cache_dir or default_cache_dir(), name))
+
+    @staticmethod
+    def file_key(entry, options):
+        return (entry.stat.st_mtime_ns, entry.stat.st_size, entry.stat.st_ino, options)
+
+    def get_section(self, entry, options, need_hash=False):
+        # Returns (section, skip_reason, content_hash) for an unchanged file, or
+        # None. With need_hash, entries stored without a content hash are misses.
+        self.seen.add(entry.path)
+        if self.keys.get(entry.path) != self.file_key(entry, options):
+            self.misses += 1
+            return None
+        row = self.db.execute("SELECT section, skip_reason, content_hash FROM sections WHERE path = ?",
+                              (entry.path,)).fetchone()
+        if row is None or (need_hash and row[0] is not None and row[2] is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def put_section(self, entry, options, section, skip_reason, content_hash=None):
+        if time.time_ns() - entry.stat.st_mtime_ns < CACHE_RACY_WINDOW_NS:
+            return
+        key = self.file_key(entry, options)
+        self.keys[entry.path] = key
+        self.db.execute("INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (entry.path,) + key + (section, skip_reason, content_hash))
+
+    def get_tokens(self, entry, counter, options):
+        self.seen.add(entry.path)
+        cached = self.token_counts.get((entry.path, counter))
+        if cached is None or cached[0] != self.file_key(entry, options):
+            return None
+        return cached[1]
+
+    def put_tokens(self, entry, counter, options, tokens):
+        if time.time_ns() - entry.stat.st_mtime_ns < CACHE_RACY_WINDOW_NS:
+            return
+        key = self.file_key(entry, options)
+        self.token_counts[(entry.path, counter)] = (key, tokens)
+        self.db.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (entry.path, counter) + key + (tokens,))
+
+    def get_layout(self, output_file):
+        # Block layout of the last output written to `output_file`, if the file
+        # has not been touched since
+        row = self.db.execute("SELECT mtime_ns, size, layout FROM outputs WHERE output_path = ?",
+                              (os.path.abspath(output_file),)).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(output_file)
+        except OSError:
+            return None
+        if (st.st_mtime_ns, st.st_size) != (row[0], row[1]):
+            return None
+        return [tuple(block) for block in json.loads(row[2])]
+
+    def put_layout(self, output_file, layout):
+        st = os.stat(output_file)
+        self.db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)",
+                        (os.path.abspath(output_file), st.st_mtime_ns, st.st_size, json.dumps(layout)))
+
+    def start_run(self):
+        # Forget which files were seen, for a cache kept open across several
+        # merges (--watch); close() only keeps the files of the last one
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        # Drop rows for files that no longer exist or are no longer included
+        stale = [(path,) for path in self.keys if path not in self.seen]
+        self.db.executemany("DELETE FROM sections WHERE path = ?", stale)
+        stale = [key for key in self.token_counts if key[0] not in self.seen]
+        self.db.executemany("DELETE FROM tokens WHERE path = ? AND counter = ?", stale)
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# One rendered file section. `section` is None for skipped or unreadable files;
+# `cached` tells whether it came from the MergeCache. With deduplication,
+# `duplicate_of` names the earlier file with identical content, and `section`
+# is then a short reference to it.
+FileSection = collections.namedtuple('FileSection', ['entry', 'section', 'skip_reason', 'error', 'cached',
+                                                     'content_hash', 'duplicate_of'])
+
+def section_options(max_size_kb, truncation=None):
+    options = f"v{SECTION_FORMAT_VERSION};max_size={max_size_kb}"
+    if truncation is not None:
+        options += f";truncate={truncation.window}:{int(truncation.skeleton)}"
+    return options
+
+def render_duplicate_section(file_path, original_path):
+    return f"\n\n## File: {file_path}\n\nIdentical to {original_path}. Content not repeated.\n".encode("utf-8")
+
+def section_content(file_path, section):
+    # The file content inside a section from render_file_section, or None for
+    # sections without one (over the size limit, duplicates). Working from the
+    # section lets the other output formats reuse cached sections.
+    head = render_section_head(file_path)
+    if section.startswith(head) and section.endswith(SECTION_TAIL):
+        return section[len(head):len(section) - len(SECTION_TAIL)]
+    return None
+
+def render_jsonl_record(result, truncated=False, compacted=False, hashes=None):
+    # `hash` is the hash of `content` as written, so compacted and truncated
+    # contents are hashed again here; a duplicate gets the hash written for
+    # the file it duplicates. `hashes` maps paths to the hashes written so far.
+    entry = result.entry
+    content = section_content(entry.path, result.section)
+    digest = result.content_hash
+    if content is not None and (truncated or compacted):
+        digest = content_hash(content)
+    elif result.duplicate_of is not None and hashes is not None:
+        digest = hashes.get(result.duplicate_of, digest)
+    if hashes is not None:
+        hashes[entry.path] = digest
+    record = {"path": entry.path, "size": entry.stat.st_size, "hash": digest,
+              "language": file_language(entry.path),
+              "content": None if content is None else content.decode("utf-8", errors="replace")}
+    if result.duplicate_of is not None:
+        record["duplicate_of"] = result.duplicate_of
+    elif content is None:
+        record["note"] = "exceeds size limit"
+    elif truncated:
+        record["truncated"] = True
+        record["note"] = "truncated to its head and tail"
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+DEFAULT_LICENSE_PATTERN = r"copyright|licen[cs]e|SPDX-License-Identifier"
+# Comment syntax per language (see LANGUAGES) for compaction: line comment
+# prefix and block comment delimiters, None where the language has none
+COMMENT_SYNTAX = {
+    'python': ('#', None), 'shell': ('#', None), 'ruby': ('#', None), 'yaml': ('#', None), 'toml': ('#', None),
+    'sql': ('--', ('/*', '*/')), 'css': (None, ('/*', '*/')), 'scss': ('//', ('/*', '*/')),
+    'html': (None, ('<!--', '-->')), 'xml': (None, ('<!--', '-->')), 'markdown': (None, ('<!--', '-->')),
+}
+C_LIKE_LANGUAGES = ('c', 'cpp', 'csharp', 'java', 'javascript', 'typescript', 'go', 'rust', 'kotlin', 'swift', 'php')
+COMMENT_SYNTAX.update((language, ('//', ('/*', '*/'))) for language in C_LIKE_LANGUAGES)
+# Strings are matched so comment markers inside them are left alone. A block
+# comment takes its whole line only when its first '*/' ends the line, so the
+# body of that form must not run past a '*/'.
+C_LIKE_TOKEN = re.compile(r"""
+    ^[ \t]*//[^\n]*\n
+  | ^[ \t]*/\*[^*]*\*+(?:[^/*][^*]*\*+)*/[ \t]*\n
+  | "(?:\\.|[^"\\\n])*"
+  | '(?:\\.|[^'\\\n])*'
+  | `(?:\\.|[^`\\])*`
+  | //[^\n]*
+  | /\*.*?\*/
+""", re.S | re.X | re.M)
+TRAILING_WHITESPACE = re.compile(r"[ \t]+$", re.M)
+BLANK_RUNS = re.compile(r"\n{3,}")
+
+def strip_python_comments(text):
+    # Drops every comment token except a shebang, and the lines that held
+    # nothing else; returns `text` unchanged when it does not tokenize as Python.
+    # Lines are split like tokenize splits them (only at '\n'; splitlines also
+    # breaks at form feeds and other separators, which shifts the rows).
+    lines = io.StringIO(text).readlines()
+    try:
+        comments = [token.start for token in tokenize.generate_tokens(io.StringIO(text).readline)
+                    if token.type == tokenize.COMMENT]
+    except (tokenize.TokenError, SyntaxError):
+        return text
+    for row, col in comments:
+        line = lines[row - 1]
+        if row == 1 and line.startswith('#!'):
+            continue
+        code = line[:col].rstrip()
+        lines[row - 1] = code + line[len(line.rstrip('\r\n')):] if code else ''
+    return ''.join(lines)
+
+def strip_c_like_comments(text):
+    # Best effort: regex literals in JavaScript are not recognised
+    return C_LIKE_TOKEN.sub(lambda m: m.group() if m.group()[0] in '"\'`' else '', text)
+
+def leading_comment_end(text, language):
+    # Offset just past the comment lines that open `text` (blank lines and a
+    # shebang included), or 0 when it does not open with a comment. A block
+    # comment with code after its closing delimiter ends the header before it.
+    line_prefix, block = COMMENT_SYNTAX.get(language, (None, None))
+    offset = end = 0
+    in_block = False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if in_block or (block and stripped.startswith(block[0])):
+            opened = not in_block
+            in_block = block[1] not in (stripped[len(block[0]):] if opened else stripped)
+            if not in_block and not stripped.endswith(block[1]):
+                break
+        elif not (line_prefix and stripped.startswith(line_prefix)) and not (offset == 0 and line.startswith('#!')):
+            if stripped:
+                break
+        offset += len(line)
+        if stripped:
+            end = offset
+    return end
+
+def collapse_blank_lines(text, after_line=False):
+    # Runs of blank lines become one. With after_line, `text` continues a line
+    # that has already ended, so a leading newline is itself a blank line.
+    text = BLANK_RUNS.sub("\n\n", text)
+    if after_line and text.startswith("\n\n"):
+        text = text[1:]
+    return text
+
+class Compactor:
+    # Optional stage between reading and rendering that shrinks file contents:
+    # a license header (a leading comment matching `license_pattern`) is kept
+    # the first time it is seen and replaced by a one-line reference in later
+    # files, trailing whitespace is stripped and runs of blank lines collapse
+    # to one. With strip_comments, comments are dropped too in Python (via
+    # tokenize) and C-like languages. Files must be fed in output order, since
+    # which copy of a header is kept depends on it. `saved` counts the bytes
+    # each step removed; `counter` estimates the tokens saved. Only files
+    # passed to compact() are counted, not sections taken from the cache.
+    def __init__(self, strip_comments=False, license_pattern=DEFAULT_LICENSE_PATTERN, counter=None):
+        self.strip_comments = strip_comments
+        self.license_regex = re.compile(license_pattern, re.I) if license_pattern else None
+        self.counter = counter or byte_ratio_counter()
+        self.licenses = {}  # Header text -> first file that had it
+        self.saved = collections.Counter()
+        self.bytes_in = self.bytes_out = 0
+        self.tokens_in = self.tokens_out = 0
+
+    def options(self):
+        # Part of the section cache key
+        pattern = self.license_regex.pattern if self.license_regex else ""
+        return f"compact={int(self.strip_comments)}:{pattern}"
+
+    def split_license(self, file_path, text, language):
+        # (head, body): head is the shebang and license header of a file that
+        # opens with one, or the reference that replaces a header seen before
+        if self.license_regex is None:
+            return "", text
+        end = leading_comment_end(text, language)
+        start = text.find('\n') + 1 if text.startswith('#!') else 0
+        header = text[start:end].strip()
+        if not header or not self.license_regex.search(header):
+            return "", text
+        first = self.licenses.setdefault(header, file_path)
+        if first == file_path:
+            return text[:end], text[end:]
+        line_prefix, block = COMMENT_SYNTAX[language]
+        if line_prefix:
+            note = f"{line_prefix} License header as in {first}"
+        else:
+            note = f"{block[0]} License header as in {first} {block[1]}"
+        return text[:start] + note + "\n", text[end:]
+
+    def compact(self, file_path, content):
+        # Compacted UTF-8 content of one file. A kept license header is left
+        # exactly as it is; the other steps only touch the rest of the file.
+        language = file_language(file_path)
+        head, body = self.split_license(file_path, content.decode("utf-8", errors="replace"), language)
+        head_size = len(head.encode("utf-8"))
+        size = len(body.encode("utf-8"))
+        self.saved["license headers"] += len(content) - head_size - size
+        steps = []
+        if self.strip_comments and language == 'python':
+            steps.append(("comments", strip_python_comments))
+        elif self.strip_comments and language in C_LIKE_LANGUAGES:
+            steps.append(("comments", strip_c_like_comments))
+        steps.append(("trailing whitespace", lambda t: TRAILING_WHITESPACE.sub("", t)))
+        steps.append(("blank lines", lambda t: collapse_blank_lines(t, bool(head))))
+        for name, step in steps:
+            compacted = step(body)
+            if compacted != body:
+                compacted_size = len(compacted.encode("utf-8"))
+                self.saved[name] += size - compacted_size
+                body, size = compacted, compacted_size
+        data = (head + body).encode("utf-8")
+        self.bytes_in += len(content)
+        self.bytes_out += len(data)
+        self.tokens_in += self.counter.count(content)
+        self.tokens_out += self.counter.count(data)
+        return data
+
+    def report(self):
+        saved = self.bytes_in - self.bytes_out
+        percent = 100 * saved / self.bytes_in if self.bytes_in else 0
+        parts = ", ".join(f"{name} {count}" for name, count in self.saved.most_common() if count)
+        return (f"Compaction saved {saved} bytes ({percent:.1f}%), ~{self.tokens_in - self.tokens_out} tokens "
+                f"({self.counter.name})" + (f": {parts}" if parts else ""))
+
+def iter_file_sections(files, max_size_kb, jobs=1, cache=None, dedup=False, hash_all=False, executor=None, stats=None,
+                       compactor=None, truncation=None):
+    # Rendered sections in input order. Files whose cached section is still valid
+    # are not read at all; the rest go through iter_file_contents. With dedup,
+    # files that share their size with another file are hashed, and every copy
+    # after the first is replaced by a reference to it. `files` may also be a
+    # lazy iterator (see ProjectMerge with tree_last); sizes are then unknown up
+    # front, so with dedup every file is hashed. hash_all hashes every file.
+    # Reads are recorded in `stats` (a MergeStats) when given. A Compactor
+    # runs on every file read, in order. A Truncation keeps the head and tail
+    # of files over the size limit.
+    options = section_options(max_size_kb, truncation)
+    if compactor is not None:
+        options += ";" + compactor.options()
+    hash_sizes = set()
+    if hash_all:
+        hash_sizes = None
+    elif dedup:
+        if isinstance(files, list):
+            size_counts = collections.Counter(entry.stat.st_size for entry in files)
+            hash_sizes = {size for size, count in size_counts.items() if count > 1}
+        else:
+            hash_sizes = None
+
+    def lookup(entry):
+        return cache.get_section(entry, options, hash_sizes is None or entry.stat.st_size in hash_sizes)
+
+    first_paths = {}
+    results = iter_file_contents(files, max_size_kb, jobs, hash_sizes, lookup if cache is not None else None, executor,
+                                 truncation)
+    for result in results:
+        entry = result.entry
+        if stats is not None:
+            stats.record_read(result)
+        if result.cached is not None:
+            section, skip_reason, digest = result.cached
+            from_cache = True
+        else:
+            if result.error is not None:
+                yield FileSection(entry, None, None, result.error, False, None, None)
+                continue
+            section, skip_reason, digest = None, result.skip_reason, result.content_hash
+            if skip_reason is None:
+                content = result.content
+                if compactor is not None and content is not None:
+                    content = compactor.compact(entry.path, content)
+                section = render_file_section(entry.path, content, result.size, max_size_kb)
+            if cache is not None:
+                cache.put_section(entry, options, section, skip_reason, digest)
+            from_cache = False
+
+        duplicate_of = None
+        if dedup and digest is not None:
+            duplicate_of = first_paths.setdefault(digest, entry.path)
+            if duplicate_of == entry.path:
+                duplicate_of = None
+            else:
+                section = render_duplicate_section(entry.path, duplicate_of)
+        yield FileSection(entry, section, skip_reason, None, from_cache, digest, duplicate_of)
+
+BYTES_PER_TOKEN = 4
+
+class TokenCounter:
+    # Counts tokens in rendered output. `name` identifies the tokenizer in the
+    # cache; counters with needs_content=False work from file sizes and only
+    # read the first bytes of each file, to leave out binaries (see
+    # count_file_tokens).
+    def __init__(self, name, count, needs_content=True):
+        self.name = name
+        self.count = count
+        self.needs_content = needs_content
+
+def byte_ratio_counter(_arg=None):
+    return TokenCounter("bytes", lambda data: -(-len(data) // BYTES_PER_TOKEN), needs_content=False)
+
+def tiktoken_counter(encoding_name=None):
+    encoding = tiktoken.get_encoding(encoding_name or "cl100k_base")
+    def count(data):
+        return len(encoding.encode(data.decode("utf-8", errors="ignore"), disallowed_special=()))
+    return TokenCounter(f"tiktoken:{encoding.name}", count)
+
+# Tokenizer name -> factory taking the optional text after ':' in the spec
+# (e.g. "tiktoken:o200k_base"). Register more here to plug in other tokenizers.
+TOKENIZERS = {
+    "bytes": byte_ratio_counter,
+    "tiktoken": tiktoken_counter,
+}
+
+def get_token_counter(spec):
+    name, _, arg = spec.partition(":")
+    if name not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer '{name}' (available: {', '.join(sorted(TOKENIZERS))})")
+    if name == "tiktoken" and tiktoken is None:
+        print("Warning: tiktoken is not installed, falling back to byte-ratio token estimates")
+        return byte_ratio_counter()
+    return TOKENIZERS[name](arg or None)
+
+def estimate_section_size(entry, max_size_kb, truncation=None):
+    # Byte length render_file_section will produce, from the stat size alone
+    # (an upper bound for truncated files)
+    if entry.stat.st_size / 1024 > max_size_kb:
+        if truncation is not None:
+            return len(render_file_section(entry.path, b"", 0, max_size_kb)) + 3 * truncation.window + 100
+        return len(render_file_section(entry.path, None, entry.stat.st_size, max_size_kb))
+    return len(render_file_section(entry.path, b"", 0, max_size_kb)) + entry.stat.st_size
+
+def sniff_file(file_path):
+    # sniff_binary on the head of a file; None (text) when it cannot be read,
+    # which is reported once the file is merged
+    try:
+        with open(file_path, "rb") as f:
+            return sniff_binary(f.read(BINARY_SNIFF_SIZE))
+    except OSError:
+        return None
+
+def find_binary_files(entries):
+    # Paths of the files in `entries` that will be skipped as binary, for
+    # callers that count tokens over and over without reading files again
+    return {entry.path for entry in entries if entry.stat is not None and sniff_file(entry.path) is not None}
+
+def count_file_tokens(files, max_size_kb, counter, jobs=1, cache=None, executor=None, truncation=None,
+                      binary_files=None):
+    # Estimated tokens of each file's section, keyed by path, or None for files
+    # that will be skipped as binary. Content-based counts are cached per file,
+    # so unchanged files are not re-tokenized. Counters without needs_content
+    # sniff each file's head, unless `binary_files` (see find_binary_files)
+    # already has the verdicts.
+    tokens = {}
+    if not counter.needs_content:
+        for entry in files:
+            if binary_files is not None:
+                binary = entry.path in binary_files
+            else:
+                binary = sniff_file(entry.path) is not None
+            if binary:
+                tokens[entry.path] = None
+            else:
+                tokens[entry.path] = -(-estimate_section_size(entry, max_size_kb, truncation) // BYTES_PER_TOKEN)
+        return tokens
+
+    options = section_options(max_size_kb, truncation)
+    misses = []
+    for entry in files:
+        cached = cache.get_tokens(entry, counter.name, options) if cache is not None else None
+        if cached is not None:
+            tokens[entry.path] = cached
+        else:
+            misses.append(entry)
+    for result in iter_file_sections(misses, max_size_kb, jobs, cache, executor=executor, truncation=truncation):
+        if result.skip_reason is not None:
+            tokens[result.entry.path] = None  # Found again through the section cache next time
+            continue
+        count = counter.count(result.section) if result.section is not None else 0
+        tokens[result.entry.path] = count
+        if cache is not None and result.error is None:
+            cache.put_tokens(result.entry, counter.name, options, count)
+    return tokens
+
+# Order in which files claim the token budget
+PRIORITIES = {
+    "depth": lambda entry: (entry.depth, entry.path),
+    "recent": lambda entry: (-entry.stat.st_mtime_ns, entry.path),
+    "size": lambda entry: (entry.stat.st_size, entry.path),
+}
+
+def render_omitted_line(entry, tokens):
+    return f"- {entry.path} (~{tokens} tokens)\n"
+
+def render_omitted_section(omitted, tokens, token_budget):
+    lines = [f"\n\n## Omitted Files\n\nLeft out to stay within the token budget of {token_budget} tokens:\n\n"]
+    lines.extend(render_omitted_line(entry, tokens[entry.path]) for entry in omitted)
+    return "".join(lines).encode("utf-8")
+
+def pack_token_budget(files, tokens, token_budget, priority, counter, used_tokens=0):
+    # Greedily fills the budget in priority order, skipping files that do not
+    # fit so smaller ones later in the order can still use the space. Every
+    # omitted file costs a line in the omitted list, so that cost is reserved up
+    # front and released when the file is included; so is the list's heading
+    # when not everything fits. Files that will be skipped as binary (None in
+    # `tokens`) cost nothing and are never omitted. Returns (included, omitted)
+    # in the original order, plus the estimated total.
+    candidates = [entry for entry in files if tokens[entry.path] is not None]
+    line_tokens = {entry.path: counter.count(render_omitted_line(entry, tokens[entry.path]).encode("utf-8"))
+                   for entry in candidates}
+    heading_tokens = 0
+    if used_tokens + sum(tokens[entry.path] for entry in candidates) > token_budget:
+        heading_tokens = counter.count(render_omitted_section([], {}, token_budget))
+    used_tokens += heading_tokens + sum(line_tokens.values())
+    included = {entry.path for entry in files if tokens[entry.path] is None}
+    for entry in sorted(candidates, key=PRIORITIES[priority]):
+        extra = tokens[entry.path] - line_tokens[entry.path]
+        if used_tokens + extra <= token_budget:
+            included.add(entry.path)
+            used_tokens += extra
+    if len(included) == len(files):
+        used_tokens -= heading_tokens
+    return ([entry for entry in files if entry.path in included],
+            [entry for entry in files if entry.path not in included],
+            used_tokens)
+
+# One piece of merge output. `name` is the file path for file sections, "" for
+# the header, "omitted" for the omitted-files list and "structure" for a
+# trailing folder structure. `data` is None when there is nothing to write
+# (a skipped or unreadable file, see `result`, or the header of a format that
+# has none). `result` is the FileSection for file blocks and None otherwise.
+MergeBlock = collections.namedtuple('MergeBlock', ['name', 'data', 'result'])
+
+# markdown: the human-readable document. jsonl: one JSON record per file
+# (render_jsonl_record). pack: raw contents for PackOutputWriter.
+OUTPUT_FORMATS = ("markdown", "jsonl", "pack")
+
+class ProjectMerge:
+    # Library entry point. A merge is a lazy pipeline: enumerate and filter the
+    # project (scan), then read and render the files (blocks), yielding each
+    # block as soon as it is ready so it can go to any sink without a temporary
+    # file. Normally the scan runs up front, since the header holds the full
+    # structure listing; with tree_last the structure goes at the end and files
+    # are read while the scan is still running, so the first block is out
+    # before any directory is opened. The cache, if any, belongs to the caller.
+    # A MergeStats passed as `stats` collects scan and read counters. A
+    # Compactor shrinks file contents before they are rendered; the token
+    # budget is still counted on the original contents. A Truncation keeps
+    # the head and tail of files over max_size_kb instead of leaving them out.
+    #
+    #     merge = ProjectMerge("./project", patterns=["*.py"])
+    #     merge.write_to(sys.stdout.buffer)
+    def __init__(self, project_path, max_depth=4, max_size_kb=100, patterns=('*',), exclude_patterns=None,
+                 jobs=1, git=False, dedup=False, cache=None, token_budget=None, token_counter=None,
+                 priority="depth", contents_heading="# File Contents", extra_config=(), tree_last=False,
+                 output_format="markdown", executor=None, stats=None, compactor=None, truncation=None):
+        self.project_path = project_path
+        self.max_depth = max_depth
+        self.max_size_kb = max_size_kb
+        self.patterns = list(patterns)
+        self.exclude_patterns = DEFAULT_EXCLUDE_PATTERNS if exclude_patterns is None else exclude_patterns
+        self.jobs = jobs
+        self.git = git
+        self.dedup = dedup
+        self.cache = cache
+        self.token_budget = token_budget
+        self.token_counter = token_counter or byte_ratio_counter()
+        self.priority = priority
+        self.contents_heading = contents_heading
+        self.extra_config = list(extra_config)
+        if token_budget is not None:
+            self.extra_config.append(f"Token budget: {token_budget}")
+        self.tree_last = tree_last
+        self.output_format = output_format
+        self.executor = executor
+        self.stats = stats
+        self.compactor = compactor
+        self.truncation = truncation
+        self.entries = None
+        self.files = None
+        self.omitted = []
+        self.tokens = {}
+        self.used_tokens = None
+        self.skipped = []
+        self.duplicates = 0
+        self.record_hashes = {}  # JSONL record hashes by path
+
+    def gitignore_matcher(self):
+        return parse_gitignore(os.path.join(self.project_path, '.gitignore'), self.exclude_patterns)
+
+    def iter_entries(self):
+        # The filtered entries, yielded as they are scanned the first time and
+        # kept in `entries` once the scan is complete. With git=True, raises
+        # OSError or subprocess.CalledProcessError when git cannot list the files.
+        if self.entries is not None:
+            yield from self.entries
+            return
+        gitignore_matcher = self.gitignore_matcher()
+        if self.git:
+            # Tracked files are never gitignored, so only the exclude patterns apply
+            entries = scan_git_files(self.project_path, gitignore_matcher.exclude_matcher, self.patterns)
+        else:
+            entries = iter_project_entries(self.project_path, gitignore_matcher, self.patterns, self.stats)
+        scanned = []
+        for entry in entries:
+            scanned.append(entry)
+            yield entry
+        self.entries = scanned
+
+    def scan(self):
+        if self.entries is None:
+            for _ in self.iter_entries():
+                pass
+        return self.entries
+
+    def render_header(self, with_structure=True):
+        structure = render_structure(self.scan(), self.patterns, self.max_depth) if with_structure else None
+        return render_header(self.max_depth, self.max_size_kb, self.patterns, structure,
+                             self.contents_heading, self.extra_config)
+
+    def stream_files(self):
+        # Files in scan order while the scan is running; `files` grows with them
+        self.files = []
+        for entry in self.iter_entries():
+            if entry.stat is not None:
+                self.files.append(entry)
+                yield entry
+
+    def render_block(self, result):
+        if self.output_format == "jsonl":
+            truncated = is_truncated(result.entry.stat.st_size, self.max_size_kb, self.truncation)
+            return render_jsonl_record(result, truncated, self.compactor is not None, self.record_hashes)
+        if self.output_format == "pack":
+            return section_content(result.entry.path, result.section)
+        return result.section
+
+    def blocks(self):
+        # Generator of MergeBlocks in output order. `files` is set before the
+        # header is yielded (and grows while files stream in with tree_last);
+        # `skipped` and `duplicates` fill in as files go by.
+        streaming = self.tree_last and self.token_budget is None
+        if streaming:
+            header = self.render_header(with_structure=False)
+            files = self.stream_files()
+        else:
+            header = self.render_header(with_structure=not self.tree_last)
+            files = project_files(self.scan())
+            if self.token_budget is not None:
+                self.tokens = count_file_tokens(files, self.max_size_kb, self.token_counter, self.jobs, self.cache,
+                                                self.executor, self.truncation)
+                files, self.omitted, self.used_tokens = pack_token_budget(
+                    files, self.tokens, self.token_budget, self.priority, self.token_counter,
+                    self.token_counter.count(header))
+            self.files = files
+        markdown = self.output_format == "markdown"
+        yield MergeBlock("", header if markdown else None, None)
+
+        # A pack stores identical contents once by itself and needs the content
+        # of every file, so sections never turn into references there
+        dedup = self.dedup and self.output_format != "pack"
+        # Which copy of a license header is kept depends on the whole run, so
+        # sections compacted that way are never taken from the cache
+        cache = self.cache
+        if self.compactor is not None and self.compactor.license_regex is not None:
+            cache = None
+        sections = iter_file_sections(files, self.max_size_kb, self.jobs, cache, dedup,
+                                      hash_all=self.output_format == "jsonl", executor=self.executor, stats=self.stats,
+                                      compactor=self.compactor, truncation=self.truncation)
+        try:
+            for result in sections:
+                if result.error is not None or result.skip_reason is not None:
+                    if result.skip_reason is not None:
+                        self.skipped.append((result.entry.path, result.skip_reason))
+                    yield MergeBlock(result.entry.path, None, result)
+                    continue
+                if result.duplicate_of is not None:
+                    self.duplicates += 1
+                yield MergeBlock(result.entry.path, self.render_block(result), result)
+        finally:
+            sections.close()  # Shuts down the reader threads when the consumer stops early
+
+        if not markdown:
+            return
+        if self.omitted:
+            yield MergeBlock("omitted", render_omitted_section(self.omitted, self.tokens, self.token_budget), None)
+        if self.tree_last:
+            structure = render_structure(self.scan(), self.patterns, self.max_depth)
+            yield MergeBlock("structure", render_structure_footer(structure), None)
+
+    def write_to(self, sink):
+        # Writes every block to `sink`: an output writer (anything with
+        # write_block) or any binary file-like object such as an open file,
+        # sys.stdout.buffer, io.BytesIO or socket.makefile("wb"). Raises the
+        # first read error. Returns the sink.
+        write_block = getattr(sink, "write_block", None)
+        for block in self.blocks():
+            if block.result is not None and block.result.error is not None:
+                raise block.result.error
+            if block.data is None:
+                continue
+            if write_block is not None:
+                write_block(block.name, block.data)
+            else:
+                sink.write(block.data)
+        return sink
+
+    def to_bytes(self):
+        return self.write_to(io.BytesIO()).getvalue()
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+class InotifyWatcher:
+    # Change notifications from Linux inotify, called through ctypes so no
+    # extra package is needed. One watch per included directory. Raises
+    # OSError where inotify is not available.
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths = {}  # Directory path -> watch descriptor
+        self.watches = {}  # Watch descriptor -> directory path
+
+    def watch(self, tree):
+        # Raises OSError when the kernel's watch limit is reached
+        directories = set(tree.directories())
+        for path in list(self.paths):
+            if path not in directories:
+                wd = self.paths.pop(path)
+                self.watches.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+        for path in directories:
+            if path in self.paths:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:  # ENOSPC: out of watches
+                    raise OSError(errno, "inotify watch limit reached (see fs.inotify.max_user_watches)")
+                continue  # Gone again or unreadable; its parent's listing will tell
+            self.paths[path] = wd
+            self.watches[wd] = path
+
+    def wait(self, timeout=None):
+        # Changes as a set of (directory, name) pairs, empty after `timeout`
+        # seconds without any, or None when events were lost
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+                offset += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                dir_path = self.watches.get(wd)
+                if dir_path is not None and name and not mask & IN_IGNORED:
+                    changes.add((dir_path, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+WATCH_POLL_INTERVAL = 1.0  # Seconds between polls of the fallback watcher
+WATCH_POLL_FILES = 2000  # Files checked per poll on top of the recently changed ones
+WATCH_HOT_NS = 10 * 60 * 10 ** 9  # Files modified this recently are checked on every poll
+
+class PollingWatcher:
+    # Fallback for systems without inotify. Each poll stats every directory,
+    # which catches created, deleted and renamed entries (and editors that save
+    # by renaming), plus the files modified in the last WATCH_HOT_NS and the
+    # next WATCH_POLL_FILES of the others in rotation. The stat load per poll
+    # stays bounded on huge trees; in-place edits of long-untouched files are
+    # noticed within one rotation.
+    def __init__(self):
+        self.directories = {}
+        self.files = {}
+        self.rotation = []
+        self.next_file = 0
+        self.hot = set()
+        self.last_poll = 0.0
+
+    @staticmethod
+    def stat_key(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def watch(self, tree):
+        self.directories = {path: self.directories.get(path) or self.stat_key(path) for path in tree.directories()}
+        now = time.time_ns()
+        self.files = {}
+        self.hot = set()
+        for entry in project_files(tree.entries()):
+            self.files[entry.path] = (entry.stat.st_mtime_ns, entry.stat.st_size)
+            if now - entry.stat.st_mtime_ns < WATCH_HOT_NS:
+                self.hot.add(entry.path)
+        self.rotation = list(self.files)
+        self.next_file = 0
+
+    def wait(self, timeout=None):
+        # Same contract as InotifyWatcher.wait
+        delay = WATCH_POLL_INTERVAL - (time.monotonic() - self.last_poll)
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if delay > 0:
+            time.sleep(delay)
+        self.last_poll = time.monotonic()
+        return self.poll()
+
+    def poll(self):
+        changes = set()
+        for path, key in self.directories.items():
+            new_key = self.stat_key(path)
+            if new_key != key:
+                self.directories[path] = new_key
+                changes.add((path, None))
+        batch = self.rotation[self.next_file:self.next_file + WATCH_POLL_FILES]
+        self.next_file = self.next_file + WATCH_POLL_FILES if self.next_file + WATCH_POLL_FILES < len(self.rotation) else 0
+        for path in self.hot.union(batch):
+            new_key = self.stat_key(path)
+            if new_key != self.files.get(path):
+                self.files[path] = new_key
+                self.hot.add(path)
+                changes.add((os.path.dirname(path) or '.', os.path.basename(path)))
+        return changes
+
+    def close(self):
+        pass
+
+WATCH_DEBOUNCE = 0.3  # Seconds without further changes before the output is updated
+WATCH_MAX_DELAY = 2.0  # Longest an update waits for a burst of changes to settle
+
+def wait_for_changes(watcher):
+    # Blocks until something changed and the burst has settled. Returns the
+    # collected (directory, name) pairs, or None when everything must be rescanned.
+    changes = set()
+    while not changes:
+        changes = watcher.wait()
+        if changes is None:
+            break
+    deadline = time.monotonic() + WATCH_MAX_DELAY
+    while time.monotonic() < deadline:
+        more = watcher.wait(WATCH_DEBOUNCE)
+        if more is not None and not more:
+            break
+        changes = None if changes is None or more is None else changes | more
+    return changes
+
+def watch_project(args, new_merge, output_file, cache, counter):
+    # --watch: one full merge, then an update after every settled burst of
+    # changes. Only the directories that changed are listed again, sections
+    # of unchanged files come from the cache and the output is patched from
+    # the first block that differs. Runs until interrupted.
+    output_path = os.path.abspath(output_file)
+    output_root = os.path.splitext(output_path)[0]
+
+    def is_output(dir_path, name):
+        path = os.path.abspath(os.path.join(dir_path, name))
+        return path == output_path or path.startswith(output_root + "_part") or path == output_root + "_manifest.json"
+
+    def update(tree):
+        start = time.monotonic()
+        cache.start_run()
+        merge = new_merge()
+        merge.entries = tree.entries()
+        out, previous_layout = write_merge(args, merge, output_file, cache, counter)
+        cache.commit()
+        written = f"patched {out.bytes_written} bytes" if previous_layout is not None else f"wrote {out.bytes_written} bytes"
+        print(f"[{datetime.datetime.now():%H:%M:%S}] {output_file}: {cache.misses} files read, "
+              f"{cache.hits} sections reused, {written} in {time.monotonic() - start:.2f}s")
+
+    project_path = os.path.normpath(args.project_path)  # Tree keys must match os.path.dirname of entries
+    merge = new_merge()
+    tree = ProjectTree(project_path, merge.gitignore_matcher(), merge.patterns)
+    update(tree)
+    try:
+        watcher = InotifyWatcher()
+        watcher.watch(tree)
+    except OSError as e:
+        print(f"Warning: {e}; falling back to polling")
+        watcher = PollingWatcher()
+        watcher.watch(tree)
+    print(f"Watching {args.project_path} for changes (Ctrl+C to stop)")
+
+    try:
+        while True:
+            changes = wait_for_changes(watcher)
+            if changes is not None:
+                changes = {(d, name) for d, name in changes if name is None or not is_output(d, name)}
+                if not changes:
+                    continue
+            if changes is None or any(name == '.gitignore' for _, name in changes):
+                tree = ProjectTree(project_path, new_merge().gitignore_matcher(), merge.patterns)
+            else:
+                tree.update({d for d, _ in changes})
+            update(tree)
+            try:
+                watcher.watch(tree)
+            except OSError as e:
+                print(f"Warning: {e}; falling back to polling")
+                watcher.close()
+                watcher = PollingWatcher()
+                watcher.watch(tree)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.close()
+        cache.close()
+
+BATCH_ROOTS_IN_FLIGHT = 4  # Projects merged at the same time in batch mode
+
+# Outcome of one project in a batch. `error` is None on success.
+BatchResult = collections.namedtuple('BatchResult', ['project_path', 'output_file', 'files', 'bytes_written',
+                                                     'skipped', 'seconds', 'error'])
+
+def read_batch_manifest(manifest_file):
+    # One project path per line, relative to the manifest's directory; blank
+    # lines and lines starting with '#' are ignored
+    base = os.path.dirname(manifest_file)
+    with open(manifest_file, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+
+def batch_output_files(roots, output_dir, timestamp, extension):
+    # PROJECT_NAME_TIMESTAMP per project, numbered when two projects share a name
+    names = collections.Counter(os.path.basename(os.path.abspath(root)) for root in roots)
+    seen = collections.Counter()
+    output_files = []
+    for root in roots:
+        name = os.path.basename(os.path.abspath(root))
+        seen[name] += 1
+        if names[name] > 1:
+            name = f"{name}_{seen[name]}"
+        output_files.append(os.path.join(output_dir, f"{name}_{timestamp}{extension}"))
+    return output_files
+
+def merge_batch(targets, merge_root, in_flight=BATCH_ROOTS_IN_FLIGHT):
+    # Runs merge_root(project_path, output_file) for every target pair,
+    # `in_flight` at a time, and returns BatchResults in input order.
+    # merge_root returns (files, bytes_written, skipped); an exception only
+    # fails its own project and is recorded in the result.
+    def run(target):
+        project_path, output_file = target
+        start = time.monotonic()
+        try:
+            files, bytes_written, skipped = merge_root(project_path, output_file)
+        except Exception as e:
+            return BatchResult(project_path, output_file, 0, 0, 0, time.monotonic() - start, f"{type(e).__name__}: {e}")
+        return BatchResult(project_path, output_file, files, bytes_written, skipped, time.monotonic() - start, None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=in_flight) as executor:
+        return list(executor.map(run, targets))
+
+def run_batch(args, roots, new_merge, counter, timestamp, extension):
+    # Batch mode: every project is merged into its own file in the output
+    # directory (-o, default: the current directory) by this one process.
+    # BATCH_ROOTS_IN_FLIGHT projects run at a time and their file reads share
+    # one pool of --jobs threads. A summary is printed and saved as JSON.
+    output_dir = args.output or "."
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = batch_output_files(roots, output_dir, timestamp, extension)
+    read_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+
+    def merge_root(project_path, output_file):
+        if not os.path.isdir(project_path):
+            raise NotADirectoryError(f"'{project_path}' does not exist or is not a directory")
+        cache = None
+        if args.cache or args.cache_dir or args.incremental:
+            cache = MergeCache.for_project(project_path, args.cache_dir)
+        try:
+            merge = new_merge(project_path, cache, read_pool)
+            out, _ = write_merge(args, merge, output_file, cache, counter, show_progress=False)
+        finally:
+            if cache is not None:
+                cache.close()
+        log_verbose(f"Merged {project_path} -> {output_file}", args.verbose)
+        return len(merge.files), out.bytes_written, len(merge.skipped)
+
+    start = time.monotonic()
+    try:
+        results = merge_batch(list(zip(roots, output_files)), merge_root)
+    finally:
+        if read_pool is not None:
+            read_pool.shutdown()
+    elapsed = time.monotonic() - start
+
+    failed = [result for result in results if result.error is not None]
+    for result in results:
+        if result.error is not None:
+            print(f"FAILED  {result.project_path}: {result.error}")
+        else:
+            print(f"ok      {result.project_path} -> {result.output_file} "
+                  f"({result.files} files, {result.bytes_written} bytes, {result.seconds:.2f}s)")
+    summary_file = os.path.join(output_dir, f"batch_summary_{timestamp}.json")
+    with open(summary_file, "w", encoding="utf-8") as f:
+        json.dump({"projects": len(results), "failed": len(failed), "seconds": round(elapsed, 3),
+                   "results": [dict(result._asdict(), seconds=round(result.seconds, 3)) for result in results]}, f, indent=2)
+    print(f"Batch complete: {len(results) - len(failed)}/{len(results)} projects merged in {elapsed:.2f}s")
+    print(f"Summary: {os.path.abspath(summary_file)}")
+
+def shard_limit(args, counter):
+    # (limit, cost, unit) for --split-size or --split-tokens
+    if args.split_tokens is not None:
+        return args.split_tokens, counter.count, "tokens"
+    return args.split_size, len, "bytes"
+
+def shard_header_renderer(merge):
+    def render_shard_header(structure_entries, part):
+        shard_structure = render_structure(structure_entries, merge.patterns, merge.max_depth)
+        return render_header(merge.max_depth, merge.max_size_kb, merge.patterns, shard_structure,
+                             extra_config=merge.extra_config + [f"Part: {part}"])
+    return render_shard_header
+
+def write_merge(args, merge, output_file, cache, counter, stream=None, show_progress=True):
+    # Writes one merge with the output writer the command line asks for.
+    # Returns the writer and the layout it patched (None for a full rewrite).
+    # With merge.stats, time spent producing blocks counts as "read" and
+    # writing them (including the final flush) as "write".
+    stats = merge.stats
+    sharded = args.split_size is not None or args.split_tokens is not None
+    to_stdout = output_file == "-"
+    previous_layout = cache.get_layout(output_file) if args.incremental and not sharded else None
+    if sharded:
+        limit, cost, unit = shard_limit(args, counter)
+        # Shards list their own slice of the structure, so the scan must be done
+        out = ShardedOutputWriter(output_file, limit, cost, unit, shard_header_renderer(merge), merge.scan(),
+                                  args.compress, args.compress_thread)
+    elif args.format == "pack":
+        out = PackOutputWriter(output_file)
+    elif to_stdout:
+        out = StreamOutputWriter(stream, compression=args.compress, compress_threaded=args.compress_thread)
+    elif previous_layout is not None:
+        out = PatchingOutputWriter(output_file, previous_layout)
     else:
-        with open(output_file, "a", encoding="utf-8") as out:
-            out.write(f"\n\n## File: {file_path}\n\n")
-            out.write(f"File exceeds size limit ({file_size_kb:.2f}KB > {max_size_kb}KB). Content not included.\n")
+        out = OutputWriter(output_file, record_layout=cache is not None, compression=args.compress,
+                           compress_threaded=args.compress_thread)
+
+    with out:
+        blocks = merge.blocks()
+        if stats is not None:
+            blocks = stats.timed(blocks, "read")
+        for i, block in enumerate(blocks):
+            if block.result is not None and block.result.error is not None:
+                raise block.result.error
+            if block.data is not None:
+                write_start = time.perf_counter()
+                out.write_block(block.name, block.data)
+                if stats is not None:
+                    stats.add_time("write", time.perf_counter() - write_start)
+            if not show_progress:
+                continue
+            if i == 0:
+                log_verbose("Header written to output", args.verbose)
+                if not args.tree_last:
+                    log_verbose(f"Total files to process: {len(merge.files)}", args.verbose)
+                if merge.used_tokens is not None:
+                    log_verbose(f"Token budget: ~{merge.used_tokens}/{args.token_budget} tokens ({counter.name}), "
+                                f"{len(merge.omitted)} files omitted", args.verbose)
+            elif args.verbose and block.result is not None:
+                total = "?" if merge.entries is None else len(merge.files)  # Still scanning
+                print(f"\rProcessing files: {i}/{total}", end="", flush=True)
+        close_start = time.perf_counter()
+    if stats is not None:
+        stats.add_time("write", time.perf_counter() - close_start)
+        stats.counters["bytes_written"] = out.bytes_written
+
+    if cache is not None and not sharded and not to_stdout:
+        cache.put_layout(output_file, out.layout)
+    return out, previous_layout
+
+PROFILE_TOP_FUNCTIONS = 25
 
 def main():
     args = parse_arguments()
+    if args.profile is None:
+        run(args)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        print(f"Profile: {os.path.abspath(args.profile)}", file=sys.stderr)
 
+def run(args):
     if args.custom:
-        max_depth, max_size, patterns, exclude_patterns = custom_config()
+        # With -o - stdout carries the merge, so the prompts go to stderr
+        with contextlib.redirect_stdout(sys.stderr if args.output == "-" else sys.stdout):
+            max_depth, max_size, patterns, exclude_patterns = custom_config()
     else:
         max_depth = args.max_depth
         max_size = args.max_size
         patterns = args.patterns
         exclude_patterns = DEFAULT_EXCLUDE_PATTERNS
 
-    if not os.path.isdir(args.project_path):
+    roots = list(args.project_paths)
+    if args.batch:
+        try:
+            roots.extend(read_batch_manifest(args.batch))
+        except OSError as e:
+            print(f"Error: Could not read batch manifest '{args.batch}': {e}")
+            return
+    if not roots:
+        print("Error: No project path given.")
+        return
+    batch = len(roots) > 1 or args.batch is not None
+    args.project_path = roots[0]
+
+    if not batch and not os.path.isdir(args.project_path):
         print(f"Error: The specified project path '{args.project_path}' does not exist or is not a directory.")
         return
 
-    project_name = os.path.basename(os.path.abspath(args.project_path))
+    sharded = args.split_size is not None or args.split_tokens is not None
+    compression = None
+    if args.compress:
+        try:
+            compression = get_compressor(args.compress)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        if args.incremental:
+            print("Error: --incremental cannot patch a compressed output file.")
+            return
+    if sharded and args.tree_last:
+        print("Error: --tree-last cannot be combined with --split-size or --split-tokens.")
+        return
+    if sharded and args.format != "markdown":
+        print("Error: --split-size and --split-tokens only work with the markdown format.")
+        return
+    if args.format == "pack" and (args.output == "-" or compression is not None or args.incremental):
+        print("Error: --format pack needs a plain output file (no -o -, --compress or --incremental).")
+        return
+
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_file = args.output or f"{project_name}_{timestamp}.md"
+    extension = {"markdown": ".md", "jsonl": ".jsonl", "pack": ".pack"}[args.format]
+    if compression is not None and not sharded:
+        extension += compression.extension  # Shards get the compression extension themselves
     patterns = patterns.split(',')
 
+    counter = None
+    if args.token_budget is not None or args.split_tokens is not None:
+        try:
+            counter = get_token_counter(args.tokenizer)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+
+    def new_compactor():
+        if not (args.compact or args.strip_comments):
+            return None
+        return Compactor(args.strip_comments, args.license_pattern, counter)
+
+    truncation = None
+    if args.truncate or args.skeleton or args.truncate_window is not None:
+        truncation = Truncation(args.truncate_window or max(max_size * 1024 // 2, 1), args.skeleton)
+
+    def new_merge(project_path, cache, executor=None, stats=None):
+        return ProjectMerge(project_path, max_depth, max_size, patterns, exclude_patterns,
+                            jobs=args.jobs, git=args.git, dedup=args.dedup, cache=cache,
+                            token_budget=args.token_budget, token_counter=counter, priority=args.priority,
+                            tree_last=args.tree_last, output_format=args.format, executor=executor, stats=stats,
+                            compactor=new_compactor(), truncation=truncation)
+
+    if sharded:
+        limit, cost, unit = shard_limit(args, counter)
+        minimum = min_shard_limit(shard_header_renderer(new_merge(args.project_path, None)), cost)
+        if limit <= minimum:
+            option = "--split-tokens" if args.split_tokens is not None else "--split-size"
+            print(f"Error: {option} must be more than {minimum} {unit}, the cost of a part's header and a minimal section.")
+            return
+    if args.stats is not None and (batch or args.watch):
+        print("Error: --stats reports on a single merge and cannot be combined with batch mode or --watch.")
+        return
+    if batch:
+        if args.output == "-" or args.watch:
+            print("Error: Batch mode writes one file per project; -o - and --watch are not supported.")
+            return
+        exclude_patterns = ExcludeMatcher(exclude_patterns)  # Compiled once for all projects
+        run_batch(args, roots, new_merge, counter, timestamp, extension)
+        return
+
+    project_name = os.path.basename(os.path.abspath(args.project_path))
+    output_file = args.output or f"{project_name}_{timestamp}{extension}"
+
+    to_stdout = output_file == "-"
+    if to_stdout and (sharded or args.incremental):
+        print("Error: --split-size, --split-tokens and --incremental need an output file, not stdout.")
+        return
+    if args.watch and (to_stdout or args.git):
+        print("Error: --watch needs an output file and cannot be combined with --git.")
+        return
+    if args.watch:
+        # Keep sections in the cache between updates and patch the output in place where the format allows
+        args.cache = True
+        args.incremental = not sharded and compression is None and args.format != "pack"
+    stream = None
+    if to_stdout:
+        # The merge owns stdout; all messages go to stderr
+        stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
     log_verbose(f"Project path: {args.project_path}", args.verbose)
     log_verbose(f"Output file: {output_file}", args.verbose)
     log_verbose(f"Max depth: {max_depth}", args.verbose)
     log_verbose(f"Max file size: {max_size}KB", args.verbose)
     log_verbose(f"File patterns: {patterns}", args.verbose)
 
-    gitignore_matcher = parse_gitignore(os.path.join(args.project_path, '.gitignore'), exclude_patterns)
-
-    with open(output_file, "w", encoding="utf-8") as out:
-        out.write("# Project Knowledge for AI Analysis\n\n")
-        out.write("This markdown file contains the structure and contents of a project. ")
-        out.write("It is organized as follows:\n\n")
-        out.write("1. Project folder structure\n")
-        out.write("2. Contents of relevant files\n\n")
-        out.write("---\n\n")
-        out.write("## Project Configuration\n\n")
-        out.write(f"- Max directory depth: {max_depth}\n")
-        out.write(f"- Max file size: {max_size}KB\n")
-        out.write(f"- File patterns included: {', '.join(patterns)}\n\n")
-        out.write("---\n\n")
-        out.write("## Project Folder Structure\n\n")
-        
-        structure = list_directory(args.project_path, max_depth=max_depth, gitignore_matcher=gitignore_matcher, patterns=patterns)
-        out.write("\n".join(structure))
-        
-        out.write("\n\n# File Contents\n")
+    cache = None
+    if args.cache or args.cache_dir or args.incremental:
+        cache = MergeCache.for_project(args.project_path, args.cache_dir)
+        log_verbose(f"Cache file: {cache.cache_file}", args.verbose)
 
-    log_verbose("Project structure written to output file", args.verbose)
+    if args.watch:
+        watch_project(args, lambda: new_merge(args.project_path, cache), output_file, cache, counter)
+        return
 
-    files_to_process = []
-    for root, _, files in os.walk(args.project_path):
-        if 'node_modules' in root.split(os.path.sep):
-            continue  # Skip node_modules folders
-        for file in files:
-            file_path = os.path.join(root, file)
-            if should_include_file(file_path, gitignore_matcher, patterns):
-                files_to_process.append(file_path)
+    stats = MergeStats() if args.stats is not None else None
+    start = time.perf_counter()
+    merge = new_merge(args.project_path, cache, stats=stats)
+    try:
+        if not args.tree_last or args.git:
+            merge.scan()
+            if stats is not None:
+                stats.add_time("scan", time.perf_counter() - start)
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, "stderr", None)
+        reason = stderr.decode(errors="replace").strip() if stderr else str(e)
+        print(f"Error: Could not list git-tracked files in '{args.project_path}': {reason}")
+        return
 
-    log_verbose(f"Total files to process: {len(files_to_process)}", args.verbose)
+    out, previous_layout = write_merge(args, merge, output_file, cache, counter, stream)
+    if stats is not None:
+        stats.add_time("total", time.perf_counter() - start)
 
-    for i, file_path in enumerate(files_to_process, 1):
-        append_file_content(file_path, output_file, max_size)
-        if args.verbose:
-            print(f"\rProcessing files: {i}/{len(files_to_process)}", end="", flush=True)
+    if cache is not None:
+        cache.close()
 
     if args.verbose:
         print()  # New line after progress
+        for file_path, reason in merge.skipped:
+            print(f"Skipped {file_path}: {reason}")
+        if args.dedup:
+            print(f"Deduplicated: {merge.duplicates} files identical to an earlier one")
+        if cache is not None:
+            print(f"Cache: {cache.hits} sections reused, {cache.misses} files read")
+        if previous_layout is not None:
+            print(f"Incremental: kept {out.bytes_reused} bytes, wrote {out.bytes_written} bytes")
+
+    if merge.compactor is not None:
+        print(merge.compactor.report())
+    if stats is not None:
+        if args.stats:
+            with open(args.stats, "w", encoding="utf-8") as f:
+                json.dump(stats.to_dict(), f, indent=2)
+            print(f"Stats: {os.path.abspath(args.stats)}")
+        else:
+            print(stats.report())
 
-    print(f"Markdown file created: {output_file}")
+    if sharded:
+        print(f"Markdown files created: {len(out.shards)} parts of at most {out.limit} {out.unit}")
+        print(f"Manifest: {os.path.abspath(shard_manifest_name(output_file))}")
+        return
+    if to_stdout:
+        return
+
+    kind = "Markdown" if args.format == "markdown" else args.format.upper()
+    print(f"{kind} file created: {output_file}")
     print(f"Location: {os.path.abspath(output_file)}")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except BrokenPipeError:
+        # The reader of a piped stdout went away (e.g. `| head`); keep Python
+        # from complaining again when it flushes stdout at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.__stdout__.fileno())
+        sys.exit(1)
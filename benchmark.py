@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import argparse
+import fnmatch
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then not reported
+    resource = None
+
+from aicodemerge import DEFAULT_EXCLUDE_PATTERNS, ExcludeMatcher, GitignoreMatcher, OutputWriter, ProjectMerge
+from aicodemerge import scan_index, filter_index, scan_project, project_files, iter_file_contents, render_file_section
+
+SOURCE_EXTENSIONS = ['py', 'js', 'ts', 'tsx', 'go', 'rs', 'java', 'c', 'h', 'cpp', 'rb', 'json', 'yaml']
+NOISE_NAMES = ['node_modules', '.git', 'build', 'dist', '__pycache__', 'target', 'venv', '.idea']
+NOISE_EXTENSIONS = ['pyc', 'o', 'class', 'log', 'png', 'min.js', 'bundle.js', 'so', 'md', 'txt']
+
+def synthetic_paths(root, count, seed=0):
+    # Deterministic list of file paths shaped like a monorepo checkout.
+    rng = random.Random(seed)
+    paths = []
+    while len(paths) < count:
+        depth = rng.randint(1, 8)
+        parts = [root]
+        for _ in range(depth - 1):
+            if rng.random() < 0.08:
+                parts.append(rng.choice(NOISE_NAMES))
+            else:
+                parts.append(f"pkg{rng.randint(0, 60)}")
+        if rng.random() < 0.25:
+            extension = rng.choice(NOISE_EXTENSIONS)
+        else:
+            extension = rng.choice(SOURCE_EXTENSIONS)
+        parts.append(f"file{rng.randint(0, 5000)}.{extension}")
+        paths.append(os.path.join(*parts))
+    return paths
+
+def legacy_is_ignored(patterns):
+    # The per-path fnmatch loop that ExcludeMatcher replaces.
+    def is_ignored(path):
+        path = os.path.normpath(path)
+        for pattern in patterns:
+            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
+                return True
+        return False
+    return is_ignored
+
+def time_matcher(matcher, paths):
+    start = time.perf_counter()
+    results = [matcher(path) for path in paths]
+    return time.perf_counter() - start, results
+
+def bench_matcher(count):
+    paths = synthetic_paths('project', count)
+    legacy_time, legacy_results = time_matcher(legacy_is_ignored(DEFAULT_EXCLUDE_PATTERNS), paths)
+    compiled_time, compiled_results = time_matcher(ExcludeMatcher(DEFAULT_EXCLUDE_PATTERNS), paths)
+    mismatches = sum(1 for a, b in zip(legacy_results, compiled_results) if a != b)
+
+    print(f"Paths: {count} ({sum(compiled_results)} excluded)")
+    print(f"fnmatch loop:    {legacy_time:.3f}s ({count / legacy_time:,.0f} paths/s)")
+    print(f"ExcludeMatcher:  {compiled_time:.3f}s ({count / compiled_time:,.0f} paths/s)")
+    print(f"Speedup:         {legacy_time / compiled_time:.1f}x")
+    print(f"Mismatches:      {mismatches}")
+    return mismatches == 0
+
+CODE_LINES = [
+    "import os\n", "from .util import helper\n", "\n", "def handle(request, *args):\n",
+    "    value = helper(request.path, args)\n", "    if value is None:\n", "        return []\n",
+    "    # Normalise before returning\n", "    return [item.strip() for item in value]\n",
+    "class Widget:\n", "    def __init__(self, name):\n", "        self.name = name\n",
+]
+MAX_SIZE_KB = 100  # The CLI default, so huge files take the size-limit path
+
+def code_text(rng, size):
+    # Source-like text of about `size` bytes
+    lines = []
+    length = 0
+    while length < size:
+        line = rng.choice(CODE_LINES)
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with open(path, mode) as f:
+        f.write(data)
+
+def generate_tree(root, scale=1, seed=0):
+    # Writes a deterministic project shaped like a real checkout under `root`:
+    # many small source files, a deeply nested node_modules, a .git directory
+    # full of loose objects, a few huge files, binaries and an ignored build
+    # directory. Returns the number of files written.
+    rng = random.Random(seed)
+    count = 0
+
+    for i in range(3000 * scale):
+        depth = rng.randint(0, 5)
+        parts = [f"pkg{rng.randint(0, 40)}" for _ in range(depth)]
+        extension = rng.choice(SOURCE_EXTENSIONS)
+        write_file(os.path.join(root, "src", *parts, f"file{i}.{extension}"), code_text(rng, rng.randint(200, 4000)))
+        count += 1
+
+    for i in range(1500 * scale):
+        # node_modules/a/node_modules/b/... up to eight packages deep
+        parts = []
+        for _ in range(rng.randint(1, 8)):
+            parts += ["node_modules", f"dep{rng.randint(0, 30)}"]
+        write_file(os.path.join(root, *parts, f"index{i}.js"), code_text(rng, rng.randint(100, 2000)))
+        count += 1
+
+    for i in range(2000 * scale):
+        digest = f"{rng.getrandbits(160):040x}"
+        write_file(os.path.join(root, ".git", "objects", digest[:2], digest[2:]), rng.randbytes(rng.randint(50, 1500)))
+        count += 1
+    write_file(os.path.join(root, ".git", "HEAD"), "ref: refs/heads/main\n")
+
+    for i in range(3):
+        write_file(os.path.join(root, "src", "generated", f"huge{i}.c"), code_text(rng, 8 * 1024 * 1024))
+        count += 1
+
+    for i in range(50 * scale):
+        extension = rng.choice(["bin", "dat", "png", "so"])
+        write_file(os.path.join(root, "assets", f"blob{i}.{extension}"), rng.randbytes(rng.randint(1000, 50000)))
+        count += 1
+
+    for i in range(200 * scale):
+        write_file(os.path.join(root, "build", f"out{i}.js"), code_text(rng, 1000))
+        count += 1
+    write_file(os.path.join(root, ".gitignore"), "build/\n*.log\n")
+    return count + 2
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on Linux
+
+def time_stage(stages, name, items, run, repeat):
+    # Runs `run()`, which returns (result, bytes processed), `repeat` times and
+    # records the best time, the throughput and the process's peak RSS so far.
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result, size = run()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    count = items(result)
+    stages[name] = {
+        "seconds": round(seconds, 4),
+        "items": count,
+        "bytes": size,
+        "files_per_sec": round(count / seconds, 1) if seconds else None,
+        "mb_per_sec": round(size / seconds / (1024 * 1024), 2) if seconds and size else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    return result
+
+def bench_tree(root, jobs, repeat=3):
+    # Times each stage of a merge of `root` on its own, then a full merge.
+    # Traversal and filtering use the GUI's split (scan_index/filter_index);
+    # scan is the CLI's walk, which filters while it descends.
+    stages = {}
+    gitignore_cache = {}
+    patterns = ['*']
+    index = time_stage(stages, "traverse", len, lambda: (scan_index(root, gitignore_cache), 0), repeat)
+    matcher = GitignoreMatcher(root, DEFAULT_EXCLUDE_PATTERNS, gitignore_cache)
+    time_stage(stages, "filter", len, lambda: (filter_index(index, matcher, patterns), 0), repeat)
+    entries = time_stage(stages, "scan", len,
+                         lambda: (scan_project(root, GitignoreMatcher(root, DEFAULT_EXCLUDE_PATTERNS), patterns), 0), repeat)
+    files = project_files(entries)
+
+    def read():
+        results = list(iter_file_contents(files, MAX_SIZE_KB, jobs))
+        return results, sum(len(result.content) for result in results if result.content is not None)
+    contents = time_stage(stages, "read", len, read, repeat)
+
+    def render():
+        sections = [render_file_section(result.entry.path, result.content, result.size, MAX_SIZE_KB)
+                    for result in contents if result.skip_reason is None and result.error is None]
+        return sections, sum(len(section) for section in sections)
+    sections = time_stage(stages, "render", len, render, repeat)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        def write():
+            with OutputWriter(os.path.join(out_dir, "write.md")) as out:
+                for i, section in enumerate(sections):
+                    out.write_block(str(i), section)
+            return sections, out.bytes_written
+        time_stage(stages, "write", len, write, repeat)
+
+        def merge():
+            project_merge = ProjectMerge(root, max_size_kb=MAX_SIZE_KB, jobs=jobs)
+            with open(os.path.join(out_dir, "merge.md"), "wb") as f:
+                project_merge.write_to(f)
+                return project_merge.files, f.tell()
+        time_stage(stages, "merge", len, merge, repeat)
+    return stages
+
+def print_stages(stages, baseline=None, tolerance=1.25):
+    # Returns the names of stages more than `tolerance` times slower than the baseline
+    regressions = []
+    print(f"{'stage':<10}{'seconds':>10}{'items':>9}{'files/s':>12}{'MB/s':>9}{'peak RSS':>11}  vs baseline")
+    for name, stage in stages.items():
+        mb = f"{stage['mb_per_sec']:.1f}" if stage["mb_per_sec"] is not None else "-"
+        rss = f"{stage['peak_rss_kb'] // 1024}MB" if stage["peak_rss_kb"] is not None else "-"
+        compared = ""
+        base = (baseline or {}).get(name)
+        if base and base["seconds"] and stage["seconds"]:
+            ratio = stage["seconds"] / base["seconds"]
+            compared = f"{ratio:.2f}x time"
+            if ratio > tolerance:
+                compared += "  REGRESSION"
+                regressions.append(name)
+        print(f"{name:<10}{stage['seconds']:>10.3f}{stage['items']:>9}{stage['files_per_sec'] or 0:>12,.0f}{mb:>9}{rss:>11}  {compared}")
+    return regressions
+
+def bench_tree_suite(args):
+    root = args.tree_dir
+    temp_dir = None
+    if root is None:
+        temp_dir = root = tempfile.mkdtemp(prefix="aicodemerge-bench-")
+    try:
+        if not os.path.isdir(os.path.join(root, "src")):
+            start = time.perf_counter()
+            count = generate_tree(root, args.scale, args.seed)
+            print(f"Generated {count} files in {root} ({time.perf_counter() - start:.1f}s)")
+        stages = bench_tree(root, args.jobs, args.repeat)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            stored = json.load(f)
+        if (stored["scale"], stored["seed"], stored["jobs"]) == (args.scale, args.seed, args.jobs):
+            baseline = stored["stages"]
+        else:
+            print(f"Baseline {args.baseline} was recorded with other settings; not comparing")
+    regressions = print_stages(stages, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"scale": args.scale, "seed": args.seed, "jobs": args.jobs, "stages": stages}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    if regressions:
+        print(f"Slower than baseline: {', '.join(regressions)}")
+    return not regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AI Code Merge internals on synthetic data.")
+    parser.add_argument("suite", nargs="?", choices=("matcher", "tree", "all"), default="all",
+                        help="matcher: exclusion matcher on synthetic paths; tree: merge stages on a synthetic project (default: all)")
+    parser.add_argument("-n", "--files", type=int, default=200000, help="Number of synthetic paths for the matcher (default: 200000)")
+    parser.add_argument("--scale", type=int, default=1, help="Size multiplier for the synthetic project (default: 1, about 7000 files)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic project (default: 0)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Reader threads for the tree benchmark (default: 1)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage; the fastest counts (default: 3)")
+    parser.add_argument("--tree-dir", help="Generate the project here and keep it for later runs instead of using a temp dir")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="Baseline file (default: benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run's timings as the baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Fail when a stage takes this many times its baseline time (default: 1.25)")
+    args = parser.parse_args()
+
+    ok = True
+    if args.suite in ("matcher", "all"):
+        ok = bench_matcher(args.files) and ok
+    if args.suite in ("tree", "all"):
+        if args.suite == "all":
+            print()
+        ok = bench_tree_suite(args) and ok
+    if not ok:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# Lets plain `pytest` import aicodemerge from the repository root: pytest puts
+# the directory of a rootdir conftest.py on sys.path.
@@ -0,0 +1,30 @@
+import ast
+
+from aicodemerge import strip_c_like_comments, strip_python_comments
+
+
+def test_strip_python_comments_keeps_lines_after_form_feed():
+    # splitlines() also breaks at \x0c, which used to shift tokenize's rows
+    text = 'x = 1  # one\n\x0c\ny = 2\n# drop me\nz = 3  # three\n'
+    assert strip_python_comments(text) == 'x = 1\n\x0c\ny = 2\nz = 3\n'
+
+
+def test_strip_python_comments_output_still_parses():
+    text = 'def f():\n    # comment\n\x0c\n    if e:  # why\n        return 1\n'
+    stripped = strip_python_comments(text)
+    ast.parse(stripped)
+    assert '#' not in stripped
+
+
+def test_strip_c_like_comments_keeps_code_after_block_comment():
+    assert strip_c_like_comments('/* a */ int x = 1;\nint y; /* b */\n') == ' int x = 1;\nint y; \n'
+
+
+def test_strip_c_like_comments_keeps_code_between_comments():
+    text = '/* hdr */ #include <a.h>\nint main() { return 0; }\n/* end */\n'
+    assert strip_c_like_comments(text) == ' #include <a.h>\nint main() { return 0; }\n'
+
+
+def test_strip_c_like_comments_keeps_jsdoc_typed_lines():
+    text = '/** @type {X} */ const a = 1;\n/**\n * Doc.\n */\nconst b = "/* not a comment */";\n'
+    assert strip_c_like_comments(text) == ' const a = 1;\nconst b = "/* not a comment */";\n'
@@ -0,0 +1,28 @@
+import os
+
+from aicodemerge import DEFAULT_EXCLUDE_PATTERNS, ExcludeMatcher
+from benchmark import legacy_is_ignored, synthetic_paths
+
+EXTRA_PATTERNS = ['*.min.js', 'config/master.key', os.path.join('project', 'pkg1', '*'), 'file1?.py',
+                  'file[0-4].go', '*.tar.gz', 'pkg7', '.env*']
+EXTRA_PATHS = ['config/master.key', 'project/config/master.key', 'a/b.tar.gz', 'x/.env.local', 'x/y.min.js',
+               'project/pkg1/file3.py', 'project/pkg10/file3.py', 'pkg7', 'x/pkg7/file1.c', 'file12.py',
+               'file123.py', 'file3.go', 'file7.go', './project/../project/pkg1/a.b', 'noext', '.hidden']
+
+
+def test_exclude_matcher_agrees_with_fnmatch_loop():
+    patterns = DEFAULT_EXCLUDE_PATTERNS + EXTRA_PATTERNS
+    legacy = legacy_is_ignored(patterns)
+    matcher = ExcludeMatcher(patterns)
+    paths = synthetic_paths('project', 2000) + [os.path.normpath(path) for path in EXTRA_PATHS]
+    mismatches = [path for path in paths if matcher(path) != legacy(path)]
+    assert mismatches == []
+
+
+def test_exclude_matcher_reports_the_pattern_that_matched():
+    matcher = ExcludeMatcher(['node_modules', '*.pyc', os.path.join('config', 'master.key'), 'build*'])
+    assert matcher.match(os.path.join('a', 'node_modules')) == 'node_modules'
+    assert matcher.match(os.path.join('a', 'b.cpython-311.pyc')) == '*.pyc'
+    assert matcher.match(os.path.join('config', 'master.key')) == os.path.join('config', 'master.key')
+    assert matcher.match(os.path.join('a', 'builds')) == 'build*'
+    assert matcher.match(os.path.join('a', 'b.py')) is None
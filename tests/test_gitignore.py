@@ -0,0 +1,83 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from aicodemerge import GitignoreMatcher
+
+GITIGNORES = {
+    '.gitignore': '*.log\n!keep.log\n/build\ncache/\n**/gen/*.py\nfoo/**/bar\n\\#hash\nspace\\ \ntrail   \n',
+    '.git/info/exclude': 'secret.txt\n',
+    'sub/.gitignore': '!*.log\n/local\ndata/\n*.txt\n!notes.txt\n',
+    'sub/deep/.gitignore': '*.py\n!main.py\n[abc].md\n',
+}
+
+FILES = [
+    'a.log', 'keep.log', 'build/out.o', 'sub/build/out.o', 'cache/x', 'sub/cache/x', 'cache.txt',
+    'gen/a.py', 'src/gen/b.py', 'src/gen/b.txt', 'foo/bar', 'foo/x/y/bar', 'foo/barn', '#hash', 'space ',
+    'trail', 'secret.txt', 'sub/secret.txt', 'sub/a.log', 'sub/local/x', 'local/x', 'sub/data/x',
+    'sub/deep/data/x', 'sub/notes.txt', 'sub/other.txt', 'sub/deep/m.py', 'sub/deep/main.py',
+    'sub/deep/a.md', 'sub/deep/d.md', 'data', 'sub/deep/keep.log',
+]
+
+
+def ignored_by_matcher(root, rel_path, is_dir):
+    # A path the scan never reaches counts as ignored: check every ancestor
+    # directory first, the way the scan prunes them
+    matcher = GitignoreMatcher(root, [])
+    parts = rel_path.split('/')
+    for depth in range(1, len(parts)):
+        if matcher(os.path.join(root, *parts[:depth]), True):
+            return True
+    return matcher(os.path.join(root, *parts), is_dir)
+
+
+@pytest.mark.skipif(shutil.which('git') is None, reason="git is not installed")
+def test_gitignore_matcher_agrees_with_git_check_ignore(tmp_path):
+    root = str(tmp_path)
+    subprocess.run(['git', 'init', '-q', root], check=True)
+    for rel_path, text in GITIGNORES.items():
+        os.makedirs(os.path.dirname(os.path.join(root, rel_path)), exist_ok=True)
+        with open(os.path.join(root, rel_path), 'w') as f:
+            f.write(text)
+    for rel_path in FILES:
+        os.makedirs(os.path.dirname(os.path.join(root, rel_path)), exist_ok=True)
+        open(os.path.join(root, rel_path), 'w').close()
+
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [name for name in dir_names if name != '.git']
+        for name in dir_names + file_names:
+            rel_path = os.path.relpath(os.path.join(dir_path, name), root).replace(os.sep, '/')
+            paths.append((rel_path, name in dir_names))
+
+    result = subprocess.run(['git', 'check-ignore', '--stdin'], cwd=root, check=False, capture_output=True,
+                            input='\n'.join(rel_path for rel_path, _ in paths) + '\n', text=True)
+    assert result.returncode in (0, 1), result.stderr
+    git_ignored = set(result.stdout.splitlines())
+
+    mismatches = [(rel_path, rel_path in git_ignored) for rel_path, is_dir in paths
+                  if ignored_by_matcher(root, rel_path, is_dir) != (rel_path in git_ignored)]
+    assert mismatches == []
+    assert 'keep.log' not in git_ignored and 'sub/deep/main.py' not in git_ignored
+
+
+def test_gitignore_dir_only_rule_needs_a_directory(tmp_path):
+    root = str(tmp_path)
+    with open(os.path.join(root, '.gitignore'), 'w') as f:
+        f.write('cache/\n!/keep\n/anchored\n')
+    matcher = GitignoreMatcher(root, [])
+    assert matcher.match(os.path.join(root, 'cache'), True) == ('gitignore', '.gitignore: cache/')
+    assert matcher.match(os.path.join(root, 'cache'), False) is None
+    assert matcher(os.path.join(root, 'anchored'), False)
+    assert not matcher(os.path.join(root, 'sub', 'anchored'), False)
+
+
+def test_gitignore_matcher_reports_exclude_patterns_first(tmp_path):
+    root = str(tmp_path)
+    with open(os.path.join(root, '.gitignore'), 'w') as f:
+        f.write('*.pyc\n')
+    matcher = GitignoreMatcher(root, ['*.pyc', '.gitignore'])
+    assert matcher.match(os.path.join(root, 'a.pyc')) == ('exclude_pattern', '*.pyc')
+    assert matcher.match(os.path.join(root, '.gitignore')) == ('exclude_pattern', '.gitignore')